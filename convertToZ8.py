@@ -23,8 +23,17 @@
 #
 
 from PIL import Image
+import numpy as np
 import os
-import copy
+import heapq
+import itertools
+import argparse
+import csv
+import functools
+import io
+import json
+import sys
+import time
 
 
 BAYER_1 = ((170,),)
@@ -569,6 +578,61 @@ erali1:
 
 
 
+# ASM_LOADER assemble par z88dk (z80asm -b), tel qu'il suit sprite_use dans
+# hopper.bin. Les mots de LOADER_RELOCATIONS sont relatifs a main, les
+# operandes de sprite_def, sprite_use, des tampons et de la resolution sont
+# a zero : ils sont completes par assemble_bin.
+# A refaire si ASM_LOADER change.
+ORG_ADR = 0x5000
+LOADER_BIN = bytes.fromhex(
+	"f3e5dde5cdd200110000cd8a0021562acd4401110000210000cd2d003e00cdaa"
+	"00fe2020f9cd1901dde1e1fbc9d5e5433e00328c01c5d578328901423e00328d"
+	"017e16215fcdcb002316225ecdcb00233a8c01fe002802c60716265fcdcb0016"
+	"273a8d015f3c328d01cdcb0016235ecdcb002316281e00cdcb0010c53a8c013c"
+	"328c01d1c110aee1d1c9d5e543210000c506287e328a01237e328b0123f51621"
+	"5ecdcb0016243a8a015fcdcb0016253a8b015fcdcb0016281e34cdcb00f13c32"
+	"8b012310d8c110c8e1d1c9cd8602cd7c0dc916211e08cdcb0016281e87cdcb00"
+	"16211e03cdcb0016281e84cdcb0016211e00cdcb0016281e81cdcb0016211e77"
+	"cdcb0016281e83cdcb0016211e2ecdcb0016281e82cdcb00c916211e00cdcb00"
+	"16281e81cdcb0016211ef7cdcb0016281e83cdcb0016211e6ecdcb0016281e82"
+	"cdcb00c9d5c5e516221e01cdcb0016235dcdcb0016201e01cdcb0016217c5fcd"
+	"cb002600cd770126080618c5cd770124c110f8e1d1c1c916271e00cdcb000628"
+	"162e5ccdcb0010fbc90000000000")
+LOADER_RELOCATIONS = (5, 11, 17, 26, 38, 51, 57, 63, 70, 77, 81, 93, 98, 103, 106, 112, 120, 125,
+	129, 149, 154, 162, 167, 171, 176, 180, 187, 192, 215, 222, 229, 236, 243,
+	250, 257, 264, 271, 278, 286, 293, 300, 307, 314, 321, 332, 338, 345, 352,
+	357, 365, 380, 388)
+LOADER_SPRITE_DEF = 142
+LOADER_SPRITE_USE = 23
+LOADER_TAMPONS = 8
+LOADER_RESOLUTION = 20
+LOADER_REDEF_CARS = 10
+
+
+def assemble_bin(sprite_def, sprite_use, tampons, resolution):
+	# binaire equivalent a l'asm genere : call main / ret, sprite_def,
+	# sprite_use puis le loader reloge
+	def_adr = ORG_ADR + 4
+	use_adr = def_adr + len(sprite_def)
+	main_adr = use_adr + len(sprite_use)
+	loader = bytearray(LOADER_BIN)
+
+	def patch(offset, word):
+		loader[offset:offset + 2] = (word & 0xffff).to_bytes(2, "little")
+
+	for offset in LOADER_RELOCATIONS:
+		patch(offset, int.from_bytes(loader[offset:offset + 2], "little") + main_adr)
+	patch(LOADER_SPRITE_DEF, def_adr)
+	patch(LOADER_SPRITE_USE, use_adr)
+	patch(LOADER_TAMPONS, tampons)
+	patch(LOADER_RESOLUTION, resolution)
+	if tampons == 0:
+		# call redef_cars -> 3 nop, comme dans l'asm
+		loader[LOADER_REDEF_CARS:LOADER_REDEF_CARS + 3] = bytes(3)
+	start = bytes([0xcd]) + main_adr.to_bytes(2, "little") + bytes([0xc9])
+	return start + bytes(sprite_def) + bytes(sprite_use) + bytes(loader)
+
+
 def threshold_bayer_matrix(bayer_matrix, strength):
 	mat = []
 	for i in range(0, len(bayer_matrix)):
@@ -593,53 +657,218 @@ def find_closest_color(c, palette):
 	return closest//3
 	
 
-def get_palette_data_from_string(palette_string):
+def get_palette_data(palette):
+	# couleurs du registre R3 (bit 7 = couleur 0), par numero decroissant
 	palette_data = []
-	for i in range(len(palette_string) - 1, -1, -1):
-		if palette_string[i] == '1':
+	for i in range(len(VG5K_COLORS) - 1, -1, -1):
+		if palette & (0x80 >> i):
 			vg_color = VG5K_COLORS[i]
-			# ~ print("vg_color", vg_color)
 			for j in range(0,3):
 				palette_data.append(vg_color[j])
-	# ~ print("palette_data", palette_data)
 	return palette_data
 
-def find_index(c_rgb, full_palette):
-	for i in range(0, len(full_palette)):
-		if c_rgb[0] == full_palette[i][0] and c_rgb[1] == full_palette[i][1] and c_rgb[2] == full_palette[i][2]:
-			# print(i, c_rgb[0], c_rgb[1], c_rgb[2])
-			return i
-	return 0
-		
-	
+def get_index_image(im_rgb, full_palette):
+	# numero de la couleur exacte de chaque pixel, 0 sinon
+	rgb = np.asarray(im_rgb, dtype=np.uint8).astype(np.uint32)
+	codes = (rgb[:, :, 0] << 16) | (rgb[:, :, 1] << 8) | rgb[:, :, 2]
+	index_image = np.zeros(codes.shape, dtype=np.uint8)
+	# en partant de la derniere couleur, la premiere trouvee l'emporte
+	for i in range(len(full_palette) - 1, -1, -1):
+		r, g, b = full_palette[i]
+		index_image[codes == ((r << 16) | (g << 8) | b)] = i
+	return index_image
+
+
+def get_cells(index_image, x_count, y_count):
+	# cellules 4*10 de l'image : vue (y, x, 10, 4) sans copie
+	return index_image.reshape(y_count, 10, x_count, 4).transpose(0, 2, 1, 3)
+
+
+def get_cell_histograms(index_image, x_count, y_count):
+	# Histogramme des 8 couleurs de chaque cellule 4*10 en un seul bincount
+	cells = get_cells(index_image, x_count, y_count).reshape(-1, 40).astype(np.intp)
+	offsets = np.arange(len(cells))[:, None] * len(VG5K_COLORS)
+	count_index = np.bincount((cells + offsets).ravel(), minlength=len(cells) * len(VG5K_COLORS))
+	return count_index.reshape(len(cells), len(VG5K_COLORS))
+
+
+def find_closest_palettes(count_index):
+	# Les 4 couleurs les plus frequentes de chaque cellule
+	# (a egalite, le plus petit numero)
+	palette_restriction = np.argsort(-count_index, axis=1, kind="stable")[:, :4]
+	# octet R3 : bit 7 pour la couleur 0 ... bit 0 pour la couleur 7
+	palettes = np.zeros(len(count_index), dtype=np.uint8)
+	for i in range(4):
+		palettes |= (0x80 >> palette_restriction[:, i]).astype(np.uint8)
+	return palettes
+
+
+@functools.lru_cache(maxsize=None)
+def get_remap_table():
+	# Les 70 palettes R3 de 4 couleurs parmi 8, et pour chacune la couleur
+	# que find_closest_color donne a chacune des 8 couleurs, avec l'erreur L1
+	palettes = []
+	for colors in itertools.combinations(range(len(VG5K_COLORS)), 4):
+		palette = 0
+		for i in colors:
+			palette |= 0x80 >> i
+		palettes.append(palette)
+
+	remap = np.zeros((len(palettes), len(VG5K_COLORS)), dtype=np.intp)
+	error = np.zeros((len(palettes), len(VG5K_COLORS)), dtype=np.int64)
+	for p in range(len(palettes)):
+		palette_data = get_palette_data(palettes[p])
+		colors = [i for i in range(len(VG5K_COLORS) - 1, -1, -1) if palettes[p] & (0x80 >> i)]
+		for c in range(len(VG5K_COLORS)):
+			remap[p, c] = colors[find_closest_color(VG5K_COLORS[c], palette_data)]
+			error[p, c] = sum(abs(VG5K_COLORS[c][k] - VG5K_COLORS[remap[p, c]][k]) for k in range(3))
+	return np.array(palettes, dtype=np.uint8), remap, error
+
+
+def find_optimal_palettes(count_index):
+	# Erreur de remappage des 70 palettes pour toutes les cellules d'un coup,
+	# la palette des 4 couleurs les plus frequentes est gardee a egalite
+	palettes, remap, error = get_remap_table()
+	errors = count_index @ error.T
+
+	frequent = find_closest_palettes(count_index)
+	rank = np.zeros(256, dtype=np.intp)
+	rank[palettes] = np.arange(len(palettes))
+	cells = np.arange(len(errors))
+	frequent_errors = errors[cells, rank[frequent]]
+
+	best = np.argmin(errors, axis=1)
+	optimal = np.where(errors[cells, best] < frequent_errors, palettes[best], frequent)
+	return optimal, int(errors[cells, best].sum()), int(frequent_errors.sum())
+
+
+@functools.lru_cache(maxsize=None)
+def get_canonical_table():
+	# Pour un ensemble de 3 couleurs ou moins (masque R3) et les positions
+	# (slots 0 a 3, par numero decroissant) ou elles doivent tomber, un octet
+	# R3 a 4 couleurs qui les y place, les autres couleurs ne servant qu'a
+	# combler. canon[(masque, slots)] = octet R3
+	canon = {}
+	for colors in itertools.combinations(range(len(VG5K_COLORS)), 4):
+		palette = 0
+		for i in colors:
+			palette |= 0x80 >> i
+		# couleurs de la palette par numero decroissant : slot -> couleur
+		by_slot = sorted(colors, reverse=True)
+		for k in range(1, 4):
+			for slots in itertools.combinations(range(4), k):
+				mask = 0
+				for s in slots:
+					mask |= 0x80 >> by_slot[s]
+				canon.setdefault((mask, slots), palette)
+	return canon
+
+
+@functools.lru_cache(maxsize=None)
+def get_rank_lut():
+	# rang de chaque couleur parmi les couleurs utilisees (masque R3),
+	# par numero decroissant comme les slots de la palette
+	rank = np.zeros((256, len(VG5K_COLORS)), dtype=np.uint8)
+	for mask in range(256):
+		for c in range(len(VG5K_COLORS)):
+			rank[mask, c] = sum(1 for i in range(c + 1, len(VG5K_COLORS)) if mask & (0x80 >> i))
+	return rank
+
+
+def canonical_palettes(cells, count_index, palettes):
+	# Une cellule de 3 couleurs ou moins peut choisir ses couleurs de
+	# remplissage, donc les slots ou tombent ses couleurs. Les cellules de
+	# meme forme (memes rangs de couleur aux memes pixels) prennent les
+	# slots possibles pour le plus de cellules, et partagent le meme car.
+	canon = get_canonical_table()
+	used = count_index > 0
+	masks = np.zeros(len(count_index), dtype=np.intp)
+	for c in range(len(VG5K_COLORS)):
+		masks |= np.where(used[:, c], 0x80 >> c, 0)
+	k_used = used.sum(axis=1)
+
+	palettes = palettes.copy()
+	small = np.flatnonzero(k_used <= 3)
+	if len(small) == 0:
+		return palettes
+	shapes = get_rank_lut()[masks[small, None, None], cells.reshape(-1, 10, 4)[small]]
+	shapes, group = np.unique(shapes.reshape(len(small), 40), axis=0, return_inverse=True)
+	group = group.reshape(-1)
+
+	for g in range(len(shapes)):
+		members = small[group == g]
+		k = int(k_used[members[0]])
+		choices = list(itertools.combinations(range(4), k))
+		left = set(members.tolist())
+		while left:
+			# les slots possibles pour le plus de cellules restantes
+			best = max(choices, key=lambda slots: sum((int(masks[pos]), slots) in canon for pos in left))
+			for pos in sorted(left):
+				if (int(masks[pos]), best) in canon:
+					palettes[pos] = canon[(int(masks[pos]), best)]
+					left.discard(pos)
+	return palettes
+
+
+# Jeu semi graphique G10 de la ROM EF9345 (mosaique 2*3, comme le Minitel) :
+# - lignes de sixels de 3, 4 et 3 lignes, colonnes de 2 pixels quadri ;
+# - code = $20 + sixels allumes, de haut en bas et de gauche a droite
+#   1 2 / 4 8 / 16 64 ($40 pour le sixel bas droit) ;
+# - R2 = $21 (jeu standard G10), R3 = couleur encre << 4 | couleur fond,
+#   en couleurs EF9345 (noir 0 ... blanc 7, soit 7 - indice VG5K_COLORS).
+MOSAIC_ROWS = ((0, 3), (3, 7), (7, 10))
+MOSAIC_BITS = ((0x01, 0x02), (0x04, 0x08), (0x10, 0x40))
+MOSAIC_R2 = 0x21
+
+
+@functools.lru_cache(maxsize=None)
+def get_mosaic_table():
+	# index des 64 glyphes G10 : motif 4*10 (allume ou non) -> code
+	table = {}
+	for sixels in range(64):
+		code = 0x20
+		glyph = np.zeros((10, 4), dtype=bool)
+		for row, (y0, y1) in enumerate(MOSAIC_ROWS):
+			for col in range(2):
+				if sixels & (1 << (row * 2 + col)):
+					code += MOSAIC_BITS[row][col]
+					glyph[y0:y1, 2 * col:2 * col + 2] = True
+		table[np.packbits(glyph).tobytes()] = code
+	return table
+
+
+@functools.lru_cache(maxsize=None)
+def get_slot_color_lut():
+	# indice de couleur de chaque slot, pour les 256 octets R3 (-1 si absent)
+	lut = np.full((256, 4), -1, dtype=np.intp)
+	for palette in range(256):
+		colors = [i for i in range(len(VG5K_COLORS) - 1, -1, -1) if palette & (0x80 >> i)]
+		lut[palette, :min(4, len(colors))] = colors[:4]
+	return lut
+
+
+def find_mosaic_cells(grid):
+	# Cellules affichables a l'identique par un car G10 de la ROM, en
+	# bichrome : position -> (code, R3). Le fond est la couleur du pixel
+	# haut gauche, l'encre l'autre couleur s'il y en a une.
+	pixels = get_car_pixels(grid.slices.astype(np.intp))
+	colors = get_slot_color_lut()[grid.palettes[:, None], pixels].reshape(-1, 10, 4)
+	background = colors[:, 0, 0]
+	ink = np.where(colors != background[:, None, None], colors, -1).reshape(-1, 40).max(axis=1)
+	ink = np.where(ink < 0, background, ink)
+	bichrome = ((colors == background[:, None, None]) | (colors == ink[:, None, None])).all(axis=(1, 2))
+	bichrome &= (colors >= 0).all(axis=(1, 2))
+
+	table = get_mosaic_table()
+	glyphs = np.packbits(((colors == ink[:, None, None]) & (ink != background)[:, None, None]).reshape(-1, 40), axis=1)
+	mosaic = {}
+	for pos in np.flatnonzero(bichrome):
+		code = table.get(glyphs[pos].tobytes())
+		if code is not None:
+			mosaic[int(pos)] = (code, (7 - int(ink[pos])) << 4 | (7 - int(background[pos])))
+	return mosaic
+
 
-def find_closest_palette(car, car_rgb, full_palette):
-	pixels = car.load()
-	pixels_rgb = car_rgb.load()
-	count_index = [0]*8
-	palette_restriction = []
-	for x in range(car.width):
-		for y in range(car.height):
-			c = pixels[x, y]
-			c_rgb = pixels_rgb[x, y]
-			idx = find_index(c_rgb, full_palette)
-			# print(idx, c)
-			count_index[idx] += 1
-			# count_index[c] += 1
-	# ~ print(count_index)
-	for i in range(0, 4):
-		max_count = count_index.index(max(count_index))
-		palette_restriction.append(max_count)
-		count_index[max_count] = -1
-	# ~ print("p", palette_restriction)
-	p = list("00000000")
-	for i in range(len(palette_restriction)):
-		p[palette_restriction[i]] = '1'
-	palette_string = "".join(p)
-	# ~ print(palette_string)
-	return palette_string
-	
-	
 def linear_space(x):
 	x = x / 255
 	if x <= 0.04045:
@@ -649,12 +878,547 @@ def linear_space(x):
 	return int(round(y * 255))
 
 
-def car_key_to_list(car_key):
-	l = car_key[1:].split('$')
-	rl = []
-	for v in l:
-		rl.append('$' + v)
-	return rl
+def palette_to_string(palette):
+	return '{0:08b}'.format(palette)
+
+
+def slice_list(car):
+	return ["$" + hex(v)[2:] for v in car]
+
+
+EMPTY_CAR = bytes(10)
+
+
+class CellGrid:
+	""" Cells of 4*10 px of an image: 10 slice bytes and a R3 palette byte each. """
+
+	def __init__(self, count):
+		self.slices = np.zeros((count, 10), dtype=np.uint8)
+		self.palettes = np.zeros(count, dtype=np.uint8)
+
+	def __len__(self):
+		return len(self.palettes)
+
+	def set_cells(self, slices, palettes):
+		self.slices[:] = slices
+		self.palettes[:] = palettes
+
+	def car(self, pos):
+		return self.slices[pos].tobytes()
+
+
+class CharSet:
+	""" Unique characters of a CellGrid, keyed by their packed slices. """
+
+	def __init__(self, grid, cells=None):
+		self.grid = grid
+		# car -> positions, dans l'ordre de premiere apparition
+		# (toutes les cellules de la grille, ou seulement celles de cells)
+		self.positions = {}
+		for pos in (range(len(grid)) if cells is None else cells):
+			car = grid.car(pos)
+			if car in self.positions:
+				self.positions[car].append(pos)
+			else:
+				self.positions[car] = [pos]
+
+	def __len__(self):
+		return len(self.positions)
+
+	def __iter__(self):
+		return iter(self.positions)
+
+	def keys(self):
+		return list(self.positions)
+
+	def values(self, cars):
+		# tranches des cars en tableau (n, 10)
+		return np.frombuffer(b"".join(cars), dtype=np.uint8).reshape(-1, 10)
+
+	def merge(self, car_i, car_j):
+		# car_j est remplace par car_i
+		self.positions[car_i].extend(self.positions.pop(car_j))
+
+	def regroup(self, cars):
+		# cars[r] remplace le r-ieme car, en une fois
+		positions = {}
+		for car, target in zip(list(self.positions), cars):
+			if car == target:
+				positions[car] = []
+		for car, target in zip(list(self.positions), cars):
+			positions[target].extend(self.positions[car])
+		self.positions = positions
+
+	def cells(self):
+		# positions couvertes, croissantes
+		return np.sort(np.fromiter(itertools.chain.from_iterable(self.positions.values()), dtype=np.intp))
+
+	def by_position(self):
+		dic_by_pos = [None] * len(self.grid)
+		for car in self.positions:
+			for pos in self.positions[car]:
+				dic_by_pos[pos] = car
+		return dic_by_pos
+
+
+class Checkpoint:
+	""" Periodic save of the groups of a CharSet, to resume an interrupted grouping. """
+
+	def __init__(self, filename, picture, every=10):
+		self.filename = filename
+		self.picture = picture
+		self.every = every
+		self.last = time.monotonic()
+
+	def save(self, chars):
+		groups = [[car.hex(), chars.positions[car]] for car in chars]
+		state = {"picture": self.picture, "cells": len(chars.grid), "groups": groups}
+		with open(self.filename + ".tmp", "w") as f:
+			json.dump(state, f)
+		os.replace(self.filename + ".tmp", self.filename)
+		self.last = time.monotonic()
+
+	def maybe_save(self, chars):
+		if time.monotonic() - self.last >= self.every:
+			self.save(chars)
+
+
+def resume_groups(chars, filename):
+	# reprise des groupes sauves par Checkpoint
+	with open(filename) as f:
+		state = json.load(f)
+	grid = chars.grid
+	positions = {}
+	seen = np.zeros(len(grid), dtype=int)
+	expected = np.zeros(len(grid), dtype=int)
+	expected[chars.cells()] = 1
+	if state["cells"] == len(grid):
+		for car, group in state["groups"]:
+			car = bytes.fromhex(car)
+			if any(grid.car(pos) == car for pos in group):
+				positions[car] = group
+				seen[group] += 1
+	if state["cells"] != len(grid) or len(positions) != len(state["groups"]) or (seen != expected).any():
+		print("Error: checkpoint", filename, "does not match", state["picture"])
+		sys.exit(1)
+	chars.positions = positions
+	return chars
+
+
+class Telemetry:
+	""" One record per merge of the grouping, as JSON Lines or CSV (.csv). """
+
+	FIELDS = ["merge", "seconds", "merges_per_second", "size", "distance", "distortion"]
+
+	def __init__(self, filename, chars, metric):
+		self.metric = metric
+		self.file = open(filename, "w", newline="")
+		self.writer = None
+		if filename.lower().endswith(".csv"):
+			self.writer = csv.DictWriter(self.file, fieldnames=self.FIELDS)
+			self.writer.writeheader()
+		self.count = 0
+		self.size = len(chars)
+		self.distortion = grouping_distortion(chars, metric)
+		self.start = time.monotonic()
+
+	def merge(self, chars, car_i, car_j, distance):
+		# a appeler avant que car_j ne rejoigne car_i : les cellules de car_j
+		# passent de car_j a car_i
+		positions = chars.positions[car_j]
+		grid = chars.grid
+		before = cell_distances(grid, chars.values([car_j]), positions, self.metric).sum()
+		after = cell_distances(grid, chars.values([car_i]), positions, self.metric).sum()
+		self.distortion += int(after - before)
+		self.count += 1
+		self.size -= 1
+		seconds = time.monotonic() - self.start
+		record = {"merge": self.count, "seconds": round(seconds, 6),
+			"merges_per_second": round(self.count / seconds, 1) if seconds > 0 else None,
+			"size": self.size, "distance": int(distance), "distortion": self.distortion}
+		if self.writer is not None:
+			self.writer.writerow(record)
+		else:
+			self.file.write(json.dumps(record) + "\n")
+
+	def close(self):
+		self.file.close()
+
+
+@functools.lru_cache(maxsize=None)
+def get_byte_distance_lut(metric):
+	# distance entre deux octets de tranche, pour les 256*256 paires
+	# legacy  : ecart des octets pris comme entiers
+	# hamming : nombre de pixels (2 bits) differents
+	a = np.arange(256)[:, None]
+	b = np.arange(256)[None, :]
+	if metric == "legacy":
+		return np.abs(a - b).astype(np.int32)
+	diff = a ^ b
+	lut = np.zeros((256, 256), dtype=np.int32)
+	for x in range(0, 4):
+		lut += ((diff >> (2 * x)) & 3) != 0
+	return lut
+
+
+def distance_matrix(values, metric):
+	# matrice N*N des distances entre cars, tranches (N, 10) en uint8
+	lut = get_byte_distance_lut(metric)
+	values = values.astype(np.intp)
+	diffs = np.zeros((len(values), len(values)), dtype=np.int32)
+	for k in range(values.shape[1]):
+		diffs += lut[values[:, None, k], values[None, :, k]]
+	return diffs
+
+
+@functools.lru_cache(maxsize=None)
+def get_slot_distance_lut():
+	# distance L1 entre les couleurs des 4 slots, pour chacun des 256 octets R3
+	lut = np.zeros((256, 4, 4), dtype=np.int64)
+	for palette in range(256):
+		colors = [VG5K_COLORS[i] for i in range(len(VG5K_COLORS) - 1, -1, -1) if palette & (0x80 >> i)]
+		for a in range(min(4, len(colors))):
+			for b in range(min(4, len(colors))):
+				lut[palette, a, b] = sum(abs(colors[a][k] - colors[b][k]) for k in range(3))
+	return lut
+
+
+def get_car_pixels(values):
+	# slot (2 bits) de chacun des 40 pixels des cars, tranches (N, 10)
+	shifts = 2 * np.arange(4)
+	return ((values[:, :, None] >> shifts) & 3).reshape(len(values), 40)
+
+
+def get_colour_model(chars, keys):
+	# Erreur de couleur : quand j rejoint i, les cellules de j affichent le
+	# motif de i avec leur propre palette R3.
+	# cout(i <- j) = somme sur les cellules de j et leurs pixels de la
+	# distance entre la couleur du slot de i et celle du slot de j.
+	# W[j] (4*4) cumule les distances entre slots des palettes des cellules
+	# de j, d'ou V[j][pixel, a] = W[j][a, slot de j] et cout = O[i] . V[j]
+	# avec O[i] le motif de i en one-hot : un seul produit de matrices.
+	n = len(keys)
+	pixels = get_car_pixels(chars.values(keys).astype(np.intp))
+	onehot = (pixels[:, :, None] == np.arange(4)).reshape(n, 160).astype(np.float64)
+
+	slot_distance = get_slot_distance_lut()
+	weights = np.zeros((n, 4, 4), dtype=np.int64)
+	for r, key in enumerate(keys):
+		weights[r] = slot_distance[chars.grid.palettes[chars.positions[key]]].sum(axis=0)
+	return pixels, onehot, weights
+
+
+def colour_costs(pixels, onehot, weights):
+	# matrice N*N des couts(i <- j)
+	n = len(pixels)
+	v_all = weights[np.arange(n)[:, None], :, pixels].reshape(n, 160)
+	return np.rint(onehot @ v_all.T.astype(np.float64)).astype(np.int64)
+
+
+def grouping_costs(chars, keys, metric):
+	# matrice N*N des couts(i <- j) : toutes les occurrences de j affichees
+	# avec le motif de i
+	if metric == "colour":
+		return colour_costs(*get_colour_model(chars, keys))
+	counts = np.array([len(chars.positions[key]) for key in keys], dtype=np.int64)
+	return distance_matrix(chars.values(keys), metric).astype(np.int64) * counts[None, :]
+
+
+def cell_distances(grid, cars, positions, metric):
+	# distance de chaque cellule de positions au car qu'elle affiche,
+	# cars en (len(positions), 10) ou (1, 10)
+	cars = cars.astype(np.intp)
+	wanted = grid.slices[positions].astype(np.intp)
+	if metric == "colour":
+		slot_distance = get_slot_distance_lut()
+		return slot_distance[grid.palettes[positions][:, None], get_car_pixels(cars), get_car_pixels(wanted)].sum(axis=1)
+	return get_byte_distance_lut(metric)[cars, wanted].sum(axis=1)
+
+
+def grouping_distortion(chars, metric):
+	# distorsion totale des cellules de la grille, affichees avec le car de
+	# leur groupe
+	positions = chars.cells()
+	dic_by_pos = chars.by_position()
+	cars = np.frombuffer(b"".join(dic_by_pos[pos] for pos in positions), dtype=np.uint8).reshape(-1, 10)
+	return int(cell_distances(chars.grid, cars, positions, metric).sum())
+
+
+def group_cars_kmedoids(chars, max_cars, metric, iterations=20, seed=0, deadline=None, telemetry=None):
+	# Regroupement en une fois autour de max_cars cars representatifs
+	# (medoides), choisis parmi les cars existants.
+	# Initialisation k-means++ : chaque nouveau medoide est tire avec une
+	# probabilite proportionnelle au cout de son car vers le medoide le plus
+	# proche. Puis alternance affectation / mise a jour, bornee a iterations.
+	keys = chars.keys()
+	n = len(keys)
+	if n <= max_cars:
+		return chars
+	costs = grouping_costs(chars, keys, metric)
+	counts = np.array([len(chars.positions[key]) for key in keys], dtype=np.float64)
+	rng = np.random.default_rng(seed)
+
+	medoids = [int(rng.choice(n, p=counts / counts.sum()))]
+	closest = costs[medoids[0]].copy()
+	chosen = np.zeros(n, dtype=bool)
+	chosen[medoids[0]] = True
+	while len(medoids) < max_cars:
+		weights = np.where(chosen, 0, closest).astype(np.float64)
+		if weights.sum() > 0:
+			m = int(rng.choice(n, p=weights / weights.sum()))
+		else:
+			m = int(np.flatnonzero(~chosen)[0])
+		medoids.append(m)
+		chosen[m] = True
+		closest = np.minimum(closest, costs[m])
+	medoids = np.array(medoids)
+
+	for iteration in range(iterations):
+		# affectation : chaque car rejoint son medoide le moins couteux
+		labels = np.argmin(costs[medoids], axis=0)
+		labels[medoids] = np.arange(max_cars)
+		# mise a jour : dans chaque groupe, le car de cout total minimal
+		members = np.zeros((n, max_cars), dtype=np.float64)
+		members[np.arange(n), labels] = 1
+		score = (costs.astype(np.float64) @ members)[np.arange(n), labels]
+		order = np.lexsort((score, labels))
+		first = np.r_[True, labels[order][1:] != labels[order][:-1]]
+		updated = order[first]
+		if np.array_equal(np.sort(updated), np.sort(medoids)):
+			break
+		medoids = updated
+		if deadline is not None and time.monotonic() > deadline:
+			break
+	labels = np.argmin(costs[medoids], axis=0)
+	labels[medoids] = np.arange(max_cars)
+	print(";kmedoids iterations", iteration + 1)
+
+	for j in range(n):
+		m = medoids[labels[j]]
+		if m != j:
+			if telemetry is not None:
+				telemetry.merge(chars, keys[m], keys[j], costs[m, j])
+			chars.merge(keys[m], keys[j])
+	return chars
+
+
+def group_cars_batch(chars, max_cars, metric, tolerance=0, deadline=None, checkpoint=None, telemetry=None):
+	# Regroupement par passes : a chaque passe, toutes les paires disjointes
+	# dont la difference ne depasse pas le minimum courant + tolerance sont
+	# fusionnees, dans l'ordre (difference, i, j) du glouton.
+	# Les groupes sont suivis par union-find sur les rangs des cars, les
+	# positions ne sont regroupees qu'en fin de passe.
+	keys = chars.keys()
+	rank = {key: r for r, key in enumerate(keys)}
+	n = len(keys)
+	parent = np.arange(n)
+	if metric == "colour":
+		pixels, onehot, weights = get_colour_model(chars, keys)
+	else:
+		diffs = distance_matrix(chars.values(keys), metric)
+
+	def find(r):
+		while parent[r] != r:
+			parent[r] = parent[parent[r]]
+			r = parent[r]
+		return r
+
+	alive = np.ones(n, dtype=bool)
+	size = n
+	passes = 0
+	while size > max_cars:
+		passes += 1
+		roots = np.flatnonzero(alive)
+		i_list, j_list = np.triu_indices(len(roots), 1)
+		if metric == "colour":
+			# cout(i <- j) avec les poids des groupes courants
+			costs = colour_costs(pixels[roots], onehot[roots], weights[roots])
+			forward = costs[i_list, j_list]
+			backward = costs[j_list, i_list]
+			pairs = np.minimum(forward, backward)
+			backwards = backward < forward
+		else:
+			pairs = diffs[roots[i_list], roots[j_list]]
+			backwards = np.zeros(len(pairs), dtype=bool)
+		selected = np.flatnonzero(pairs <= pairs.min() + tolerance)
+		selected = selected[np.lexsort((j_list[selected], i_list[selected], pairs[selected]))]
+
+		used = np.zeros(len(roots), dtype=bool)
+		for k in selected:
+			i, j = i_list[k], j_list[k]
+			if used[i] or used[j]:
+				continue
+			used[i] = used[j] = True
+			keep, gone = (roots[j], roots[i]) if backwards[k] else (roots[i], roots[j])
+			if telemetry is not None:
+				telemetry.merge(chars, keys[keep], keys[gone], pairs[k])
+			parent[gone] = keep
+			alive[gone] = False
+			if metric == "colour":
+				weights[keep] += weights[gone]
+			size -= 1
+			if size <= max_cars:
+				break
+			if deadline is not None and time.monotonic() > deadline:
+				break
+		chars.regroup([keys[find(rank[key])] for key in chars])
+		if checkpoint is not None:
+			checkpoint.maybe_save(chars)
+		if deadline is not None and time.monotonic() > deadline:
+			break
+	print(";batch passes", passes)
+	return chars
+
+
+def group_cars_colour(chars, max_cars, deadline=None, checkpoint=None, telemetry=None):
+	# Regroupement glouton sur l'erreur de couleur (voir get_colour_model)
+	keys = chars.keys()
+	n = len(keys)
+	pixels, onehot, weights = get_colour_model(chars, keys)
+
+	def costs_to(j):
+		# cout(i <- j) pour tous les i
+		v = weights[j][:, pixels[j]].T.reshape(160)
+		return np.rint(onehot @ v).astype(np.int64)
+
+	costs = colour_costs(pixels, onehot, weights)
+
+	# tas de (cout, i, j, sens, versions) : sens 0 = j rejoint i, 1 = i rejoint j
+	version = [0] * n
+	i_list, j_list = np.triu_indices(n, 1)
+	forward = costs[i_list, j_list]
+	backward = costs[j_list, i_list]
+	heap = list(zip(np.minimum(forward, backward).tolist(), i_list.tolist(), j_list.tolist(),
+		(backward < forward).astype(int).tolist(), [0] * len(i_list), [0] * len(i_list)))
+	heapq.heapify(heap)
+
+	alive = [True] * n
+	while len(chars) > max_cars and len(heap) > 0:
+		cost, i, j, backwards, version_i, version_j = heapq.heappop(heap)
+		if not alive[i] or not alive[j] or version[i] != version_i or version[j] != version_j:
+			continue
+		keep, gone = (j, i) if backwards else (i, j)
+		if telemetry is not None:
+			telemetry.merge(chars, keys[keep], keys[gone], cost)
+		chars.merge(keys[keep], keys[gone])
+		alive[gone] = False
+		weights[keep] += weights[gone]
+		version[keep] += 1
+		if checkpoint is not None:
+			checkpoint.maybe_save(chars)
+		if deadline is not None and time.monotonic() > deadline:
+			break
+
+		# seuls les couts vers keep changent : cout(x <- keep)
+		costs[:, keep] = costs_to(keep)
+		for x in range(n):
+			if alive[x] and x != keep:
+				i, j = min(x, keep), max(x, keep)
+				forward = costs[i, j]
+				backward = costs[j, i]
+				heapq.heappush(heap, (min(forward, backward), i, j, int(backward < forward), version[i], version[j]))
+	return chars
+
+
+def reassign_cells(chars, metric):
+	# Apres regroupement, chaque cellule prend le car restant le plus proche
+	# d'elle (a egalite, elle garde le sien) : une matrice cellules * cars.
+	grid = chars.grid
+	keys = chars.keys()
+	cells = chars.cells()
+	cars = chars.values(keys).astype(np.intp)
+	wanted = grid.slices[cells].astype(np.intp)
+	if metric == "colour":
+		slot_distance = get_slot_distance_lut()
+		wanted_pixels = get_car_pixels(wanted)
+		v = slot_distance[grid.palettes[cells, None], :, wanted_pixels].reshape(len(cells), 160)
+		onehot = (get_car_pixels(cars)[:, :, None] == np.arange(4)).reshape(len(keys), 160)
+		distances = v.astype(np.float64) @ onehot.T.astype(np.float64)
+	else:
+		lut = get_byte_distance_lut(metric)
+		distances = lut[wanted[:, None, :], cars[None, :, :]].sum(axis=2)
+
+	rank = {key: r for r, key in enumerate(keys)}
+	dic_by_pos = chars.by_position()
+	current = np.array([rank[dic_by_pos[pos]] for pos in cells], dtype=np.intp)
+	best = np.argmin(distances, axis=1)
+	rows = np.arange(len(cells))
+	best = np.where(distances[rows, best] < distances[rows, current], best, current)
+
+	positions = {}
+	for pos, r in zip(cells.tolist(), best.tolist()):
+		positions.setdefault(r, []).append(pos)
+	chars.positions = {keys[r]: positions[r] for r in range(len(keys)) if r in positions}
+	return int((best != current).sum())
+
+
+def group_cars_nearest(chars, max_cars, metric, telemetry=None):
+	# Repli quand le temps est ecoule : les max_cars cars les plus frequents
+	# sont gardes, chacun des autres rejoint le moins couteux d'entre eux.
+	keys = chars.keys()
+	counts = np.array([len(chars.positions[key]) for key in keys])
+	kept = np.sort(np.argsort(-counts, kind="stable")[:max_cars])
+	costs = grouping_costs(chars, keys, metric)
+	nearest = kept[np.argmin(costs[kept], axis=0)]
+	nearest[kept] = kept
+	if telemetry is not None:
+		for r in np.flatnonzero(nearest != np.arange(len(keys))):
+			telemetry.merge(chars, keys[nearest[r]], keys[r], costs[nearest[r], r])
+	chars.regroup([keys[r] for r in nearest])
+	return chars
+
+
+def group_cars(chars, max_cars, metric="legacy", grouping="greedy", seed=0, tolerance=0, time_budget=None, checkpoint=None, telemetry=None):
+	deadline = None if time_budget is None else time.monotonic() + time_budget
+	try:
+		if grouping == "kmedoids":
+			group_cars_kmedoids(chars, max_cars, metric, seed=seed, deadline=deadline, telemetry=telemetry)
+		elif grouping == "batch":
+			group_cars_batch(chars, max_cars, metric, tolerance, deadline, checkpoint, telemetry)
+		elif metric == "colour":
+			group_cars_colour(chars, max_cars, deadline, checkpoint, telemetry)
+		else:
+			group_cars_greedy(chars, max_cars, metric, deadline, checkpoint, telemetry)
+	except KeyboardInterrupt:
+		if checkpoint is not None:
+			checkpoint.save(chars)
+		raise
+	if len(chars) > max_cars:
+		print(";time budget exceeded, nearest representative assignment from", len(chars), "cars")
+		group_cars_nearest(chars, max_cars, metric, telemetry)
+	if checkpoint is not None:
+		checkpoint.save(chars)
+	return chars
+
+
+def group_cars_greedy(chars, max_cars, metric, deadline=None, checkpoint=None, telemetry=None):
+	# Regroupement glouton des cars ressemblants : a chaque etape, la paire
+	# (i, j) de difference minimale est fusionnee (j rejoint i).
+	# Les cles ne changent jamais lors d'une fusion, les differences sont
+	# donc calculees une seule fois et rangees dans un tas. Une fusion ne
+	# fait qu'invalider les paires du car supprime, ecartees au depilement.
+	# Le tas est ordonne sur (difference, rang de i, rang de j), soit
+	# exactement l'ordre de parcours du dictionnaire de la version en O(n3).
+	keys = chars.keys()
+	diffs = distance_matrix(chars.values(keys), metric)
+	i_list, j_list = np.triu_indices(len(keys), 1)
+	heap = list(zip(diffs[i_list, j_list].tolist(), i_list.tolist(), j_list.tolist()))
+	heapq.heapify(heap)
+
+	alive = [True] * len(keys)
+	while len(chars) > max_cars and len(heap) > 0:
+		diff, i, j = heapq.heappop(heap)
+		if not alive[i] or not alive[j]:
+			continue
+		if telemetry is not None:
+			telemetry.merge(chars, keys[i], keys[j], diff)
+		chars.merge(keys[i], keys[j])
+		alive[j] = False
+		if checkpoint is not None:
+			checkpoint.maybe_save(chars)
+		if deadline is not None and time.monotonic() > deadline:
+			break
+	return chars
 
 
 def ordered_dither(im, bayer, palette):
@@ -703,27 +1467,25 @@ def get_car_string(car):
 	return data[0:len(data)-1]
 	
 	
-def get_car_list(car, car_rgb, palette_string, full_palette):
-	pixels = car.load()
-	pixels_rgb = car_rgb.load()
-	data = []
-	for y in range(0, 10):
-		w1 = 0
-		w2 = 0
-		sl = ""
-		for x in range(0, 4):
-			c = pixels[x, y]
-			c_rgb = pixels_rgb[x, y]
-			idx = find_index(c_rgb, full_palette)
-			palette_data = get_palette_data_from_string(palette_string)
-			# index = find_closest_color(VG5K_COLORS[c], palette_data)
-			index = find_closest_color(VG5K_COLORS[idx], palette_data)
-			b = '{0:02b}'.format(index)
-			sl = b + sl
-		line = hex(int(sl, 2))
-		line = "$" + line[2:]
-		data.append(line)
-	return data
+@functools.lru_cache(maxsize=None)
+def get_slice_lut():
+	# index 2 bits de chacune des 8 couleurs pour chacun des 256 octets R3
+	lut = np.zeros((256, len(VG5K_COLORS)), dtype=np.uint8)
+	for palette in range(256):
+		palette_data = get_palette_data(palette)
+		for c in range(len(VG5K_COLORS)):
+			lut[palette, c] = find_closest_color(VG5K_COLORS[c], palette_data)
+	return lut
+
+
+def get_cells_slices(cells, palettes):
+	# 10 tranches de chaque cellule : pixel x sur les bits 2x et 2x+1
+	palettes = palettes.reshape(cells.shape[:2])
+	index = get_slice_lut()[palettes[:, :, None, None], cells]
+	slices = np.zeros(cells.shape[:3], dtype=np.uint8)
+	for x in range(0, 4):
+		slices |= index[..., x] << (2 * x)
+	return slices.reshape(-1, 10)
 
 
 def get_palette():
@@ -734,21 +1496,92 @@ def get_palette():
 
 
 def main(args):
-	if len(sys.argv) <= 1:
+	if len(args) <= 1:
 		print("")
 		print("I need the following arguments:")
 		print("	 * a picture filename")
 		print("")
-		exit()
+		sys.exit(1)
+
+	parser = argparse.ArgumentParser(description="Picture to VG5000 quadrichrome characters")
+	parser.add_argument("picture", help="picture filename")
+	parser.add_argument("--palette-select", choices=["frequent", "optimal"], default="frequent",
+		help="4 colours of each cell: the most frequent ones, or the lowest remap error (default: frequent)")
+	parser.add_argument("--metric", choices=["legacy", "hamming", "colour"], default="legacy",
+		help="distance between cars when grouping: slice bytes as integers, count of different pixels, "
+		"or colour error of the cells displaying the merged car (default: legacy)")
+	parser.add_argument("--grouping", choices=["greedy", "batch", "kmedoids"], default="greedy",
+		help="reaching 500 cars: merge the closest pair one at a time, merge all the closest disjoint pairs at each pass "
+		"(only faster than greedy with a --tolerance above 0), or cluster around 500 representative cars at once "
+		"(default: greedy)")
+	parser.add_argument("--tolerance", type=int, default=0,
+		help="batch grouping: also merge the pairs up to this much above the smallest difference of the pass, "
+		"for fewer passes but not always the closest pairs (default: 0)")
+	parser.add_argument("--seed", type=int, default=0,
+		help="random seed of the kmedoids seeding (default: 0)")
+	parser.add_argument("--time-budget", type=float, metavar="SECONDS",
+		help="grouping time limit, then the remaining cars go to the nearest of the most frequent ones")
+	parser.add_argument("--checkpoint", metavar="FILE",
+		help="save the grouping state to FILE every 10 seconds and when interrupted")
+	parser.add_argument("--resume", metavar="FILE",
+		help="start the grouping from a state saved with --checkpoint")
+	parser.add_argument("--telemetry", metavar="FILE",
+		help="write one record per merge (time, merges/s, dictionary size, distance, total distortion) "
+		"to FILE, as CSV if it ends with .csv, else as JSON Lines")
+	parser.add_argument("--reassign", action="store_true",
+		help="after grouping, give each cell the closest of the remaining cars")
+	parser.add_argument("--rom-mosaic", action="store_true",
+		help="display the cells matching a G10 semigraphic character of the ROM with it, "
+		"without redefining a car")
+	parser.add_argument("--format", choices=["asm", "bin"], default="asm",
+		help="output the z80 assembly code, or directly the binary code to load at $5000 (default: asm)")
+	parser.add_argument("-o", "--output", metavar="FILE",
+		help="write the output to FILE instead of the standard output (use it for --format bin)")
+	parser.add_argument("--canonical", action="store_true",
+		help="choose the filler colours of the cells using 3 colours or less so that cells of the same shape "
+		"share a car (changes the output)")
+	args = parser.parse_args(args[1:])
+
+	if args.format == "asm" and args.output is None:
+		convert(args)
+		return
+
+	# l'asm est garde en memoire : en cas d'erreur, seule sa derniere ligne est ecrite (stderr)
+	listing = io.StringIO()
+	stdout, sys.stdout = sys.stdout, listing
+	try:
+		result = convert(args)
+	except SystemExit:
+		print(listing.getvalue().rstrip().split("\n")[-1], file=sys.stderr)
+		raise
+	finally:
+		sys.stdout = stdout
+
+	if args.format == "asm":
+		with open(args.output, "w") as f:
+			f.write(listing.getvalue())
+		return
+
+	binary = assemble_bin(*result)
+	if args.output is None:
+		sys.stdout.flush()
+		sys.stdout.buffer.write(binary)
+		sys.stdout.buffer.flush()
+	else:
+		# fichier binaire : pas de redirection du shell, qui peut reencoder la sortie
+		with open(args.output, "wb") as f:
+			f.write(binary)
+
 
+def convert(args):
 	# C est parti...
 	
 	print(START_ADR)
 	full_palette = get_palette()
 
 
-	print(";Converting " + sys.argv[1])
-	im = Image.open(sys.argv[1])
+	print(";Converting " + args.picture)
+	im = Image.open(args.picture)
 
 	im_rgb = im.convert('RGB')
 
@@ -756,88 +1589,66 @@ def main(args):
 	
 	if width % 4 != 0:
 		print("x width must be a 4 divisor")
-		exit()
+		sys.exit(1)
 		
 	if height % 10 != 0:
 		print("y height must be a 10 divisor")
-		exit()
+		sys.exit(1)
 	
 	x_step_count = int(width / 4)
 	y_step_count = int(height / 10)
 	
-	list_cars = []
-	for y in range(0, y_step_count):
-		for x in range(0, x_step_count):
-			crop_tuple = (x * 4, y * 10, (x + 1) * 4, (y + 1) * 10)
-			car = im.crop(crop_tuple)
-			car_rgb = im_rgb.crop(crop_tuple)
-			palette = find_closest_palette(car, car_rgb, full_palette)
-			data = get_car_list(car, car_rgb, palette, full_palette)
-			list_cars.append((data, palette))
+	grid = CellGrid(x_step_count * y_step_count)
+	index_image = get_index_image(im_rgb, full_palette)
+	count_index = get_cell_histograms(index_image, x_step_count, y_step_count)
+	if args.palette_select == "optimal":
+		palettes, error, frequent_error = find_optimal_palettes(count_index)
+		print(";palette remap error", error, "(most frequent colours:", frequent_error, ")")
+	else:
+		palettes = find_closest_palettes(count_index)
+	cells = get_cells(index_image, x_step_count, y_step_count)
+	if args.canonical:
+		palettes = canonical_palettes(cells, count_index, palettes)
+	grid.set_cells(get_cells_slices(cells, palettes), palettes)
 	
-	print(";cars count:", len(list_cars))
+	print(";cars count:", len(grid))
 
 	# création dictionnaire par car
 	print(";compressing")
-	dic_by_car = {}
-	for i in range(0, len(list_cars)):
-		car = list_cars[i][0]
-		car_string = "".join(car)
-		if car_string in dic_by_car:
-			dic_by_car[car_string].append(i)
-		else:
-			dic_by_car[car_string] = []
-			dic_by_car[car_string].append(i)
-		
+	mosaic = {}
+	if args.rom_mosaic:
+		mosaic = find_mosaic_cells(grid)
+		print(";rom mosaic cells:", len(mosaic))
+	chars = CharSet(grid, [pos for pos in range(len(grid)) if pos not in mosaic])
+	if args.resume is not None:
+		resume_groups(chars, args.resume)
+		print(";resumed from", args.resume)
 
-	print(";dictionary size:", len(dic_by_car));
-	print(";ratio", len(dic_by_car), "/",  len(list_cars))
+	print(";dictionary size:", len(chars));
+	print(";ratio", len(chars), "/",  len(grid))
 	
 	
 	
 	# grouping mode
-	while len(dic_by_car) > 500:
-		diff_max = 10000000
-		i_found = 0
-		j_found = 0
-		for i in dic_by_car:
-			for j in dic_by_car:
-				if i != j:
-					s1 = 0
-					s2 = 0
-					l1 = i[1:].split('$')
-					l2 = j[1:].split('$')
-					
-					current_diff = 0
-					for k in range(0, len(l1)):
-						c1 = l1[k]
-						c2 = l2[k]
-						current_diff += abs(int(c1, 16) - int(c2, 16))
-					# print(current_diff)
-					if current_diff < diff_max:
-						diff_max = current_diff
-						i_found = i
-						j_found = j
-		print("; grouping ", i_found, j_found, " - difference", diff_max, " - dictionary size ", len(dic_by_car), flush=True)
-		i_list = dic_by_car[i_found]
-		j_list = dic_by_car[j_found]
-		i_list.extend(j_list)
-		del dic_by_car[j_found]
-		dic_by_car[i_found] = i_list
+	checkpoint = None if args.checkpoint is None else Checkpoint(args.checkpoint, args.picture)
+	telemetry = None if args.telemetry is None else Telemetry(args.telemetry, chars, args.metric)
+	group_cars(chars, 500, args.metric, args.grouping, args.seed, args.tolerance, args.time_budget, checkpoint, telemetry)
+	if telemetry is not None:
+		telemetry.close()
+	if args.reassign:
+		print(";reassigned cells", reassign_cells(chars, args.metric))
 	# fin grouping mode
+	print(";grouping distortion", grouping_distortion(chars, args.metric))
 	
-	print(";dictionary size:", len(dic_by_car));
+	print(";dictionary size:", len(chars));
 	
 	
-	if len(dic_by_car) > 500:
+	if len(chars) > 500:
 		print("Ca depasse")
-		exit()
+		sys.exit(1)
 	
 	# inversion du dictionnaire pour avoir la clé par position
-	dic_by_pos = {}
-	for i in dic_by_car:
-		for j in dic_by_car[i]:
-			dic_by_pos[j] = i
+	dic_by_pos = chars.by_position()
 	
 	
 	
@@ -853,48 +1664,29 @@ def main(args):
 	count_octet_du_tampon = 0
 	total_tampon = 0
 
-	list_dic = []
+	list_dic = chars.keys()
 	dic_index = {}
-	for car in dic_by_car:
-		list_dic.append(car)
+	sprite_def = bytearray()
+	sprite_use = bytearray()
 	
 	
 
 	
 	for i in range(0, len(list_dic), 4):
-		try:
-			car_1 = car_key_to_list(list_dic[i])
-			dic_index[list_dic[i]] = (count_bloc, count_tampon, count_octet_du_tampon)
-		except IndexError as e:
-			car_1 = ["$0","$0","$0","$0","$0","$0","$0","$0","$0","$0"]
-			palette_1 = "00000000"
-		
-		try:
-			car_2 = car_key_to_list(list_dic[i+1])
-			dic_index[list_dic[i+1]] = (count_bloc, count_tampon, count_octet_du_tampon + 1)
-		except IndexError as e:
-			car_2 = ["$0","$0","$0","$0","$0","$0","$0","$0","$0","$0"]
-			palette_2 = "00000000"
-		
-		try:
-			car_3 = car_key_to_list(list_dic[i+2])
-			dic_index[list_dic[i+2]] = (count_bloc, count_tampon, count_octet_du_tampon + 2)
-		except IndexError as e:
-			car_3 = ["$0","$0","$0","$0","$0","$0","$0","$0","$0","$0"]
-			palette_3 = "00000000"
-		
-		try:
-			car_4 = car_key_to_list(list_dic[i+3])
-			dic_index[list_dic[i+3]] = (count_bloc, count_tampon, count_octet_du_tampon + 3)
-		except IndexError as e:
-			car_4 = ["$0","$0","$0","$0","$0","$0","$0","$0","$0","$0"]
-			palette_4 = "00000000"
+		cars = []
+		cars_bytes = []
+		for k in range(0, 4):
+			if i + k < len(list_dic):
+				cars.append(slice_list(list_dic[i + k]))
+				cars_bytes.append(list_dic[i + k])
+				dic_index[list_dic[i + k]] = (count_bloc, count_tampon, count_octet_du_tampon + k)
+			else:
+				cars.append(slice_list(EMPTY_CAR))
+				cars_bytes.append(EMPTY_CAR)
 			
 		print("; Bloc", count_bloc, "  -  Tampon ", count_tampon, " - Octet", count_octet_du_tampon)
-		print("; car 1 : ", car_1)
-		print("; car 2 : ", car_2)
-		print("; car 3 : ", car_3)
-		print("; car 4 : ", car_4)
+		for k in range(0, 4):
+			print("; car", k + 1, ": ", cars[k])
 		
 		count_octet_du_tampon += 4
 		
@@ -918,17 +1710,19 @@ def main(args):
 		else:
 			# ca depasse
 			print("; Blocs limited to 7")
-			exit()
+			sys.exit(1)
 		
 		R4_hex = "$" + hex(int(R4_bits, 2))[2:]
 		R5_hex = "$" + hex(int(R5_bits, 2))[2:]
 		print ("; R4 (write) = ", R4_bits, "=", R4_hex)
 		print ("; R5 (write) = ", R5_bits, "=", R5_hex)
 		print ("	db ", R4_hex, ",", R5_hex)
+		sprite_def += bytes([int(R4_bits, 2), int(R5_bits, 2)])
 		
 			
 		for j in range(0, 10):
-			print("	   db ", car_1[j], ",", car_2[j], ",", car_3[j], ",", car_4[j])
+			print("	   db ", cars[0][j], ",", cars[1][j], ",", cars[2][j], ",", cars[3][j])
+			sprite_def += bytes(cars_bytes[k][j] for k in range(0, 4))
 		
 		print(";;;;;;;")
 		
@@ -957,60 +1751,57 @@ def main(args):
 	count_col = 0
 	count_lin = 0
 	# total_tampon = 0
-	for i in range(0, len(list_cars), 4):
-		for j in range (0, 4):
-			
-			# recherche du caractere
-			try:
-				# car = list_cars[i+j][0]
-				palette = list_cars[i+j][1]
-				car_string = dic_by_pos[i+j]
-				# print(car_string)
-				indexes = dic_index[car_string]
-				# print("found", i+j , car_string, indexes)
-				count_bloc = indexes[0]
-				count_tampon = indexes[1]
-				count_octet = indexes[2]
-				
-			except IndexError as e:
-				car = ["$0","$0","$0","$0","$0"]
-				palette = "00000000"
-				
-			
-			# calcul coordonnées
-			if count_col == x_step_count:
-				count_col = 0
-				count_lin += 1
-				if count_lin == y_step_count:
-					break
-			
-			
-			# Calcul de R1 et R2 en fonction du Bloc/Tampon/Octet
-			# R1 numero du car avec 0,1,2,3 pour Tampon 1 et 32,127 pour tampons suivants
-			# R2 11 (quadri) - Bloc 6  ou 7 (avec inv b1 et b0) 101 ou 111 - 0 - HR 0 - incrust 1 
-			# R2 : bit 1 (ou R) = 1 pour indiquer la basse resolution
-			# R2 : bit 2 (ou K) = 0 ou 1 en fct 4 premiers et 4 derniers car du tampon
-			R1_hex = "$" + hex(count_octet)[2:]
-			
-			R2_bits = ""
-			if count_bloc == 3:
-				R2_bits = "11011001"
-			elif count_bloc == 4:
-				R2_bits = "11100001"
-			elif count_bloc == 5:
-				R2_bits = "11110001"
-			elif count_bloc == 6:
-				R2_bits = "11101001"
-			elif count_bloc == 7:
-				R2_bits = "11111001"
-
-		   
-			R2_hex = "$" + hex(int(R2_bits, 2))[2:]
-			R3_hex = "$" + hex(int(palette, 2))[2:]
+	for pos in range(0, len(grid)):
+		
+		# calcul coordonnées
+		if count_col == x_step_count:
+			count_col = 0
+			count_lin += 1
+			if count_lin == y_step_count:
+				break
+		
+		if pos in mosaic:
+			# car semi graphique G10 de la ROM, en bichrome
+			code, attributes = mosaic[pos]
 			print(";;;;;;;")
-			print("; ", i+j, "- Bloc", count_bloc, " - Tampon ", count_tampon, " - Octet ", count_octet, " - (", count_col, ",", count_lin,") - Palette", palette)
-			print("	   db ", R1_hex, ",", R2_hex, ",", R3_hex)
+			print("; ", pos, "- Mosaique G10 ", "$" + hex(code)[2:], " - (", count_col, ",", count_lin,") - Encre/fond", attributes >> 4, attributes & 7)
+			print("	   db ", "$" + hex(code)[2:], ",", "$" + hex(MOSAIC_R2)[2:], ",", "$" + hex(attributes)[2:])
+			sprite_use += bytes([code, MOSAIC_R2, attributes])
 			count_col += 1
+			continue
+		
+		# recherche du caractere
+		palette = int(grid.palettes[pos])
+		count_bloc, count_tampon, count_octet = dic_index[dic_by_pos[pos]]
+		
+		
+		# Calcul de R1 et R2 en fonction du Bloc/Tampon/Octet
+		# R1 numero du car avec 0,1,2,3 pour Tampon 1 et 32,127 pour tampons suivants
+		# R2 11 (quadri) - Bloc 6  ou 7 (avec inv b1 et b0) 101 ou 111 - 0 - HR 0 - incrust 1 
+		# R2 : bit 1 (ou R) = 1 pour indiquer la basse resolution
+		# R2 : bit 2 (ou K) = 0 ou 1 en fct 4 premiers et 4 derniers car du tampon
+		R1_hex = "$" + hex(count_octet)[2:]
+		
+		R2_bits = ""
+		if count_bloc == 3:
+			R2_bits = "11011001"
+		elif count_bloc == 4:
+			R2_bits = "11100001"
+		elif count_bloc == 5:
+			R2_bits = "11110001"
+		elif count_bloc == 6:
+			R2_bits = "11101001"
+		elif count_bloc == 7:
+			R2_bits = "11111001"
+
+		   
+		R2_hex = "$" + hex(int(R2_bits, 2))[2:]
+		R3_hex = "$" + hex(palette)[2:]
+		print(";;;;;;;")
+		print("; ", pos, "- Bloc", count_bloc, " - Tampon ", count_tampon, " - Octet ", count_octet, " - (", count_col, ",", count_lin,") - Palette", palette_to_string(palette))
+		print("	   db ", R1_hex, ",", R2_hex, ",", R3_hex)
+		sprite_use += bytes([count_octet, int(R2_bits, 2), palette])
+		count_col += 1
 
 			
 	print (";;;;;;;;;;;")
@@ -1020,7 +1811,13 @@ def main(args):
 	print ("; tampons", total_tampon);
 	
 	
-	print(ASM_LOADER.replace("{1}", str(total_tampon)).replace("{2}", resolution))
+	loader = ASM_LOADER.replace("{1}", str(total_tampon)).replace("{2}", resolution)
+	if total_tampon == 0:
+		# aucun tampon (que des mosaiques) : djnz bouclerait 256 fois dans
+		# redef_cars, l'appel est remplace par 3 nop pour garder les adresses
+		loader = loader.replace("\tcall redef_cars\n", "\tnop\n\tnop\n\tnop ; aucun tampon a redefinir\n", 1)
+	print(loader)
+	return sprite_def, sprite_use, total_tampon, x_step_count << 8 | y_step_count
 	
 
 if __name__ == '__main__':
@@ -23,6 +23,7 @@
 #
 
 from PIL import Image
+import numpy as np
 import os
 import copy
 
@@ -73,16 +74,60 @@ def linear_space(x):
         y = ((x+0.055) / 1.055)**2.4
     return int(round(y * 255))
 
-def find_closest_color(c, palette):
-    diff = 100000
-    closest = 0
+# linear_space for every 8 bits value
+LINEAR_SPACE_LUT = np.array([linear_space(x) for x in range(256)], dtype=np.int32)
+
+def cube_corner_table(palette):
+    """
+    Palette index of each RGB cube corner (code: red 4, green 2, blue 1)
+    when the palette is made of the 8 corners of the cube, else None.
+    """
+    corners = [None] * 8
+    for i in range(0, len(palette)-1, 3):
+        rgb = palette[i:i+3]
+        if any(v != 0 and v != 255 for v in rgb):
+            return None
+        code = (rgb[0] // 255) * 4 + (rgb[1] // 255) * 2 + rgb[2] // 255
+        if corners[code] is None:
+            corners[code] = i//3
+    if None in corners:
+        return None
+    return np.array(corners, dtype=np.uint8)
+
+def find_closest_colors(colors, palette):
+    """ Index of the closest palette color (L1) of a whole (..., 3) array of colors. """
+    colors = np.asarray(colors)
+    corners = cube_corner_table(palette)
+    if corners is not None and np.issubdtype(colors.dtype, np.integer):
+        # With the 8 cube corners the L1 distance is minimised channel by
+        # channel: 0 up to 127, 255 from 128 (integers never tie).
+        code = ((colors[..., 0] >= 128).astype(np.uint8) << 2
+                | (colors[..., 1] >= 128).astype(np.uint8) << 1
+                | (colors[..., 2] >= 128).astype(np.uint8))
+        return corners[code]
+
+    if np.issubdtype(colors.dtype, np.integer):
+        colors = colors.astype(np.int32)
+    else:
+        colors = colors.astype(np.float64)
+    channels = np.moveaxis(colors, -1, 0)
+    closest = np.zeros(channels.shape[1:], dtype=np.uint8)
+    diff = np.full(channels.shape[1:], 100000, dtype=colors.dtype)
     for i in range(0, len(palette)-1, 3):
-        d = abs(c[0] - palette[i]) + abs(c[1] - palette[i+1]) + abs(c[2] - palette[i+2])
-        # d = ((c[0] - palette[i])**2 + (c[1] - palette[i+1])**2 + (c[2] - palette[i+2])**2)**(0.5)
-        if d < diff:
-            diff = d
-            closest = i
-    return closest//3
+        d = (np.abs(channels[0] - palette[i]) + np.abs(channels[1] - palette[i+1])
+             + np.abs(channels[2] - palette[i+2]))
+        # strict comparison keeps the first palette entry on ties
+        better = d < diff
+        closest[better] = i//3
+        np.minimum(diff, d, out=diff)
+    return closest
+
+def tile_bayer(bayer, width, height):
+    """ Threshold map of the whole frame from a bayer matrix. """
+    bayer_map = np.array(bayer, dtype=np.int32)
+    bh, bw = bayer_map.shape
+    tiled = np.tile(bayer_map, ((height + bh - 1) // bh, (width + bw - 1) // bw))
+    return tiled[:height, :width]
 
 def ordered_dither(im, bayer, palette):
     palette_data = []
@@ -91,24 +136,20 @@ def ordered_dither(im, bayer, palette):
         for j in range(0, 3):
             color = palette[i]
             palette_data.append(color[j])
-            
-    dithered_color = [0, 0, 0]
-    img = Image.new('P', (im.width, im.height))
+
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+    pixels = np.asarray(im)
+    if bayer is not None:
+        map_value = tile_bayer(bayer, im.width, im.height)
+        dithered_color = LINEAR_SPACE_LUT[pixels] + (map_value - 127)[:, :, np.newaxis]
+        index = find_closest_colors(dithered_color, palette_data)
+    else:
+        # pas de dithering
+        index = find_closest_colors(pixels.astype(np.int32), palette_data)
+
+    img = Image.frombuffer('P', (im.width, im.height), index.tobytes(), 'raw', 'P', 0, 1)
     img.putpalette(palette_data * 32)
-    pixels = im.load()
-    for x in range(im.width):
-        for y in range(im.height):
-            c = pixels[x, y]
-            if bayer is not None:
-                map_value = bayer[y % len(bayer)][x % len(bayer[0])]
-                dithered_color[0]  = linear_space(c[0]) + (map_value - 127)
-                dithered_color[1]  = linear_space(c[1]) + (map_value - 127)
-                dithered_color[2]  = linear_space(c[2]) + (map_value - 127)
-                index = find_closest_color(dithered_color, palette_data)
-            else:
-                # pas de dithering
-                index = find_closest_color(c, palette_data)
-            img.putpixel((x,y), index)
     return img
 
 def main(args):
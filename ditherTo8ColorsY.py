@@ -8,9 +8,12 @@ Arbitrary-palette positional dithering algorithm
 https://bisqwit.iki.fi/story/howto/dither/jy/
 
 Usage:
-    py ThisScript.py -i INPUT.png -o OUTPUT.png [-m num] [-d num] [-c] [-p PALETTE]
+    py ThisScript.py PICTURE GAMMA [-m num] [-c] [-t DIR] [-C N] [-u] [-j N]
 
--m num, --mode num : 0-5
+PICTURE : source picture, GAMMA : gamma correction (eg. 0.8 clearer, 1.2 darker)
+Writes im_gamma.png and im_ordered.png (2x4 dither map).
+
+-m num, --mode num : 0-9, default 8
                      0=1a, 1=1ba, 2=1bb,
                      3=faster,
                      4=tri-tone,
@@ -18,10 +21,13 @@ Usage:
                      6=algorithm 2 gamma correct,
                      7=algorithm 3
                      8=adobe like pattern dither
+                     9=algorithm 2 gamma correct, nearest reachable mixture
 
--d num, --dither num : 2 or 4 or 8 (Dither 2x2, 4x4, 8x8)
--c, --ciede2000 : enable CIEDE2000 (mode 6 and 7)
--p PALETTE, --palette PALETTE : Palette file (.png or .gpl)
+-c, --ciede2000 : enable CIEDE2000 (mode 6, 7 and 9)
+-t DIR, --plan-table DIR : directory of the precomputed mixing plan tables
+-C N, --plan-cache N : keep up to N mixing plans in a LRU cache
+-u, --unique : compute one mixing plan per distinct color
+-j N, --jobs N : dither row bands on N processes
 
 Windows10 x64 21H2 + Python 3.9.13 64bit
 """
@@ -32,8 +38,13 @@ from PIL import Image
 from tqdm import tqdm
 import argparse
 import copy
+import hashlib
+import itertools
 import math
 import re
+import numpy as np
+
+from mixingPlans import PlanCache, mixing_plan_function, plan_index, dither_bands
 
 gamma = 2.2  # Gamma correction we use.
 
@@ -198,7 +209,32 @@ def gamma_correct(v):
 
 
 def gamma_uncorrect(v):
-    return pow(v, 1.0 / gamma)
+    return math.pow(v, 1.0 / gamma)
+
+
+# numpy's own pow, atan2 and exp may round differently from the math
+# module, by one ulp. The array kernels use the math functions, so that
+# their results are the ones of the scalar functions.
+_math_pow = np.frompyfunc(math.pow, 2, 1)
+_math_atan2 = np.frompyfunc(math.atan2, 2, 1)
+_math_exp = np.frompyfunc(math.exp, 1, 1)
+
+
+def math_pow(x, y):
+    return np.asarray(_math_pow(x, y), dtype=np.float64)
+
+
+def math_atan2(y, x):
+    return np.asarray(_math_atan2(y, x), dtype=np.float64)
+
+
+def math_exp(x):
+    return np.asarray(_math_exp(x), dtype=np.float64)
+
+
+def gamma_uncorrect_array(v):
+    """ gamma_uncorrect of each value of an array. """
+    return math_pow(v, 1.0 / gamma)
 
 
 class LabItem:
@@ -218,9 +254,9 @@ class LabItem:
         threshold1 = (6 * 6 * 6.0) / (29 * 29 * 29.0)
         threshold2 = (29 * 29.0) / (6 * 6 * 3.0)
 
-        x1 = pow(x, 1.0 / 3.0) if x > threshold1 else ((threshold2 * x) + (4 / 29.0))
-        y1 = pow(y, 1.0 / 3.0) if y > threshold1 else ((threshold2 * y) + (4 / 29.0))
-        z1 = pow(z, 1.0 / 3.0) if z > threshold1 else ((threshold2 * z) + (4 / 29.0))
+        x1 = math.pow(x, 1.0 / 3.0) if x > threshold1 else ((threshold2 * x) + (4 / 29.0))
+        y1 = math.pow(y, 1.0 / 3.0) if y > threshold1 else ((threshold2 * y) + (4 / 29.0))
+        z1 = math.pow(z, 1.0 / 3.0) if z > threshold1 else ((threshold2 * z) + (4 / 29.0))
 
         self.lum = (29 * 4) * y1 - (4 * 4)
         self.a = 500 * (x1 - y1)
@@ -267,7 +303,7 @@ def color_compare_ciede2000(lab1, lab2):
 
     # Compute Cromanance and Hue angles
     cab = 0.5 * (lab1.c + lab2.c)
-    cab7 = pow(cab, 7.0)
+    cab7 = math.pow(cab, 7.0)
     g = 0.5 * (1.0 - math.sqrt(cab7 / (cab7 + 6103515625.0)))
     a1 = (1.0 + g) * lab1.a
     a2 = (1.0 + g) * lab2.a
@@ -323,7 +359,7 @@ def color_compare_ciede2000(lab1, lab2):
 
     hh = (h - 275.0) / 25.0
     ddeg = 30.0 * math.exp(-hh * hh)
-    c7 = pow(c, 7.0)
+    c7 = math.pow(c, 7.0)
     rc = 2.0 * math.sqrt(c7 / (c7 + 6103515625.0))
     l50sq = (lum - 50.0) * (lum - 50.0)
     sl = 1.0 + (0.015 * l50sq) / math.sqrt(20.0 + l50sq)
@@ -337,6 +373,127 @@ def color_compare_ciede2000(lab1, lab2):
     return dlsq * dlsq + dcsq * dcsq + dhsq * dhsq + rt * dcsq * dhsq
 
 
+def rgb_to_lab(rgb):
+    """
+    LabItem values of an (..., 3) array of r, g, b values in 0..1.
+    Return an (..., 5) array of lum, a, b, c, h.
+    """
+    rgb = np.asarray(rgb, dtype=np.float64)
+    r = rgb[..., 0]
+    g = rgb[..., 1]
+    b = rgb[..., 2]
+    xx = illum[0] * r + illum[3] * g + illum[6] * b
+    yy = illum[1] * r + illum[4] * g + illum[7] * b
+    zz = illum[2] * r + illum[5] * g + illum[8] * b
+    x = xx / (illum[0] + illum[1] + illum[2])
+    y = yy / (illum[3] + illum[4] + illum[5])
+    z = zz / (illum[6] + illum[7] + illum[8])
+
+    threshold1 = (6 * 6 * 6.0) / (29 * 29 * 29.0)
+    threshold2 = (29 * 29.0) / (6 * 6 * 3.0)
+
+    def f(v):
+        v1 = (threshold2 * v) + (4 / 29.0)
+        cube = v > threshold1
+        v1[cube] = math_pow(v[cube], 1.0 / 3.0)
+        return v1
+
+    x1 = f(x)
+    y1 = f(y)
+    z1 = f(z)
+
+    lab = np.empty(rgb.shape[:-1] + (5,))
+    lab[..., 0] = (29 * 4) * y1 - (4 * 4)
+    lab[..., 1] = 500 * (x1 - y1)
+    lab[..., 2] = 200 * (y1 - z1)
+
+    # c is sqrt(a * a + b + b), as in LabItem
+    ct = lab[..., 1] * lab[..., 1] + lab[..., 2] + lab[..., 2]
+    lab[..., 3] = np.sqrt(np.maximum(ct, 0.0))
+    lab[..., 4] = math_atan2(lab[..., 2], lab[..., 1])
+    return lab
+
+
+def ciede2000(lab1, lab2):
+    """
+    color_compare_ciede2000 for arrays of rgb_to_lab values,
+    broadcast against each other.
+    """
+    lum1, a_1, b1, cc1 = lab1[..., 0], lab1[..., 1], lab1[..., 2], lab1[..., 3]
+    lum2, a_2, b2, cc2 = lab2[..., 0], lab2[..., 1], lab2[..., 2], lab2[..., 3]
+
+    # Compute Cromanance and Hue angles
+    cab = 0.5 * (cc1 + cc2)
+    cab7 = math_pow(cab, 7.0)
+    g = 0.5 * (1.0 - np.sqrt(cab7 / (cab7 + 6103515625.0)))
+    a1 = (1.0 + g) * a_1
+    a2 = (1.0 + g) * a_2
+    c1 = np.sqrt(a1 * a1 + b1 * b1)
+    c2 = np.sqrt(a2 * a2 + b2 * b2)
+    grey1 = c1 < 1e-9
+    grey2 = c2 < 1e-9
+    grey = grey1 | grey2
+
+    h1 = np.degrees(math_atan2(b1, a1))
+    h1 = np.where(grey1, 0.0, np.where(h1 < 0.0, h1 + 360.0, h1))
+    h2 = np.degrees(math_atan2(b2, a2))
+    h2 = np.where(grey2, 0.0, np.where(h2 < 0.0, h2 + 360.0, h2))
+
+    # Compute delta L, C and H
+    dl = lum2 - lum1
+    dc = c2 - c1
+
+    dhh = h2 - h1
+    dhh = np.where(dhh > 180.0, dhh - 360.0, np.where(dhh < -180.0, dhh + 360.0, dhh))
+    dhh = np.where(grey, 0.0, dhh)
+    dh = 2.0 * np.sqrt(c1 * c2) * np.sin(np.radians(0.5 * dhh))
+
+    lum = 0.5 * (lum1 + lum2)
+    c = 0.5 * (c1 + c2)
+    h = h1 + h2
+    wrap = ~grey & (np.abs(h1 - h2) > 180.0)
+    h = np.where(wrap, np.where(h < 360.0, h + 360.0, h - 360.0), h)
+    h = np.where(grey, h, h * 0.5)
+
+    t = 1.0 \
+        - 0.17 * np.cos(np.radians(h - 30.0)) \
+        + 0.24 * np.cos(np.radians(2.0 * h)) \
+        + 0.32 * np.cos(np.radians(3.0 * h + 6.0)) \
+        - 0.2 * np.cos(np.radians(4.0 * h - 63.0))
+
+    hh = (h - 275.0) / 25.0
+    ddeg = 30.0 * math_exp(-hh * hh)
+    c7 = math_pow(c, 7.0)
+    rc = 2.0 * np.sqrt(c7 / (c7 + 6103515625.0))
+    l50sq = (lum - 50.0) * (lum - 50.0)
+    sl = 1.0 + (0.015 * l50sq) / np.sqrt(20.0 + l50sq)
+    sc = 1.0 + 0.045 * c
+    sh = 1.0 + 0.015 * c * t
+    rt = -np.sin(np.radians(2 * ddeg)) * rc
+    dlsq = dl / sl
+    dcsq = dc / sc
+    dhsq = dh / sh
+
+    return dlsq * dlsq + dcsq * dcsq + dhsq * dhsq + rt * dcsq * dhsq
+
+
+def ccir601(rgb1, rgb2):
+    """
+    color_compare_ccir601 for arrays of r, g, b values,
+    broadcast against each other.
+    """
+    rgb1 = np.asarray(rgb1)
+    rgb2 = np.asarray(rgb2)
+    luma1 = (rgb1[..., 0] * 299 + rgb1[..., 1] * 587 + rgb1[..., 2] * 114) / (255.0 * 1000.0)
+    luma2 = (rgb2[..., 0] * 299 + rgb2[..., 1] * 587 + rgb2[..., 2] * 114) / (255.0 * 1000.0)
+    lumad = luma1 - luma2
+    d = (rgb1 - rgb2) / 255.0
+    r = d[..., 0]
+    g = d[..., 1]
+    b = d[..., 2]
+    return (r * r * 0.299 + g * g * 0.587 + b * b * 0.114) * 0.75 + lumad * lumad
+
+
 def evaluate_mixing_error(r, g, b, r0, g0, b0, r1, g1, b1, r2, g2, b2, ratio, mode):
     """
     Args:
@@ -405,6 +562,81 @@ def devise_best_mixing_plan(col, mode, d_range, pal):
     return (r_colors, r_ratio)
 
 
+def mixing_candidates(d_range, pal):
+    """
+    Every (index1, index2, ratio) tried by devise_best_mixing_plan,
+    in the order of its loops.
+    """
+    candidates = []
+    len_pal = len(pal)
+    for index1 in range(len_pal):
+        for index2 in range(index1, len_pal, 1):
+            for ratio in range(d_range):
+                if index1 == index2 and ratio != 0:
+                    break
+                candidates.append((index1, index2, ratio))
+    return np.array(candidates, dtype=np.int64)
+
+
+def devise_best_mixing_plan_batch(cols, mode, d_range, pal, chunk=4096):
+    """
+    devise_best_mixing_plan (modes 0, 1 and 2) for an (N, 3) array of colors.
+    Every candidate mix is evaluated for a chunk of colors at once,
+    with the same float operations as the scalar code.
+    Return the (N, 2) array of r_colors and the (N,) array of r_ratio.
+    """
+    cols = np.asarray(cols, dtype=np.int64)
+    candidates = mixing_candidates(d_range, pal)
+    index1 = candidates[:, 0]
+    index2 = candidates[:, 1]
+    ratio = candidates[:, 2]
+    pc = np.array(pal, dtype=np.int64)
+    c1 = pc[index1]
+    c2 = pc[index2]
+
+    # Determine what mixing them in this proportion will produce
+    c0 = c1 + ratio[:, np.newaxis] * (c2 - c1) // d_range
+
+    # Penalty of the components alone, which does not depend on the color
+    if mode == 1:
+        d = (c1 - c2) / 255.0
+        cc1 = d[:, 0] * d[:, 0] + d[:, 1] * d[:, 1] + d[:, 2] * d[:, 2]
+    elif mode == 2:
+        luma1 = (c1[:, 0] * 299 + c1[:, 1] * 587 + c1[:, 2] * 114) / (255.0 * 1000.0)
+        luma2 = (c2[:, 0] * 299 + c2[:, 1] * 587 + c2[:, 2] * 114) / (255.0 * 1000.0)
+        lumad = luma1 - luma2
+        d = (c1 - c2) / 255.0
+        cc1 = (d[:, 0] * d[:, 0] * 0.299 + d[:, 1] * d[:, 1] * 0.587
+               + d[:, 2] * d[:, 2] * 0.114) * 0.75 + lumad * lumad
+        cc1 = cc1 * 0.1 * (np.abs(ratio / d_range - 0.5) + 0.5)
+        luma0 = (c0[:, 0] * 299 + c0[:, 1] * 587 + c0[:, 2] * 114) / (255.0 * 1000.0)
+
+    best = np.zeros(len(cols), dtype=np.int64)
+    for start in range(0, len(cols), chunk):
+        col = cols[start:start + chunk, np.newaxis, :]
+        d = (col - c0[np.newaxis]) / 255.0
+        r = d[:, :, 0]
+        g = d[:, :, 1]
+        b = d[:, :, 2]
+        if mode == 2:
+            # color_compare_ccir601(r, g, b, r0, g0, b0)
+            luma = (col[:, :, 0] * 299 + col[:, :, 1] * 587 + col[:, :, 2] * 114) / (255.0 * 1000.0)
+            lumad = luma - luma0[np.newaxis]
+            penalty = (r * r * 0.299 + g * g * 0.587 + b * b * 0.114) * 0.75 + lumad * lumad
+            penalty = penalty + cc1[np.newaxis]
+        else:
+            # color_compare(r, g, b, r0, g0, b0)
+            penalty = r * r + g * g + b * b
+            if mode == 1:
+                penalty = penalty + cc1[np.newaxis] * 0.1
+        # argmin keeps the first candidate on ties, like the scalar loops
+        best[start:start + chunk] = np.argmin(penalty, axis=1)
+
+    r_colors = candidates[best, :2]
+    r_ratio = ratio[best] / d_range
+    return (r_colors, r_ratio)
+
+
 def devise_best_mixing_plan_fast(col, mode, d_range, pal):
     r, g, b = col
     r_colors = [0, 0]
@@ -687,6 +919,82 @@ def devise_best_mixing_plan2g(src, n_colors, limit, luma, pal_g, meta, ciede2000
     return cols
 
 
+# Largest number of mixtures a MixTable may hold
+max_mixtures = 200000
+
+
+class MixTable:
+    """
+    Every mixture of limit palette colors reachable by algorithm 2 gamma correct,
+    with its color, Lab value and color list sorted by luminance.
+    """
+
+    def __init__(self, limit, luma, pal_g, ciede2000, pal):
+        n_colors = len(pal)
+        if math.comb(n_colors + limit - 1, limit) > max_mixtures:
+            print("Error: Too many mixtures of %d colors in a %d colors palette"
+                  % (limit, n_colors))
+            sys.exit()
+
+        mixtures = itertools.combinations_with_replacement(range(n_colors), limit)
+        self.plans = np.array([sorted(m, key=lambda x: luma[x]) for m in mixtures],
+                              dtype=np.intp)
+
+        # Gamma-corrected average, then back to 0..1
+        counts = np.zeros((len(self.plans), n_colors))
+        for k in range(limit):
+            counts[np.arange(len(self.plans)), self.plans[:, k]] += 1
+        rgb = gamma_uncorrect_array(counts @ np.array(pal_g) / limit)
+
+        # Mixtures of the same color are kept once, the first one wins
+        # as it would in a search over all of them
+        first = np.sort(np.unique(rgb, axis=0, return_index=True)[1])
+        self.plans = self.plans[first]
+        self.rgb = rgb[first]
+
+        self.ciede2000 = bool(ciede2000)
+        if self.ciede2000:
+            self.lab = rgb_to_lab(self.rgb)
+
+    def __len__(self):
+        return len(self.plans)
+
+    def nearest(self, cols, chunk=256):
+        """ Index of the nearest mixture for an (N, 3) array of colors. """
+        cols = np.asarray(cols, dtype=np.int64)
+        test = self.rgb * 255.0
+        best = np.zeros(len(cols), dtype=np.intp)
+
+        for start in range(0, len(cols), chunk):
+            src = cols[start:start + chunk]
+            if self.ciede2000:
+                inputlab = rgb_to_lab(src / 255.0)
+                penalty = ciede2000(self.lab[np.newaxis], inputlab[:, np.newaxis])
+            else:
+                penalty = ccir601(src[:, np.newaxis], test[np.newaxis])
+            best[start:start + chunk] = np.argmin(penalty, axis=1)
+
+        return best
+
+
+def devise_best_mixing_plan2t(src, table):
+    """ Nearest mixture of the table, instead of the greedy devise_best_mixing_plan2g. """
+    return table.plans[table.nearest([src])[0]].tolist()
+
+
+def gamma_palette(pal):
+    return [[gamma_correct(r / 255.0), gamma_correct(g / 255.0), gamma_correct(b / 255.0)]
+            for r, g, b in pal]
+
+
+def plan2t_positions(colors, mode, dmap, d_range, ciede2000, pal):
+    """ Palette index for each dither matrix position, mode 9. """
+    luma = [(r * 299 + g * 587 + b * 114) for r, g, b in pal]
+    table = MixTable(len(pal), luma, gamma_palette(pal), ciede2000, pal)
+    map_values = [v * len(pal) // d_range for row in dmap for v in row]
+    return table.plans[table.nearest(colors)][:, map_values]
+
+
 def devise_best_mixing_plan3(src, n_colors, limit, luma, pal_g, meta, ciede2000, pal):
     r, g, b = src
 
@@ -825,6 +1133,225 @@ def devise_best_mixing_plan3(src, n_colors, limit, luma, pal_g, meta, ciede2000,
     return cols
 
 
+def sort_plans_by_luma(r_colors, lengths, luma):
+    """
+    sorted(r_colors, key=luma) row by row, for plans of the given lengths.
+    Entries past the length of a plan stay at the end.
+    """
+    keys = np.array(luma, dtype=np.float64)[r_colors]
+    keys[np.arange(r_colors.shape[1])[np.newaxis, :] >= lengths[:, np.newaxis]] = np.inf
+    order = np.argsort(keys, axis=1, kind="stable")
+    return np.take_along_axis(r_colors, order, axis=1)
+
+
+def devise_best_mixing_plan2g_batch(srccols, n_colors, limit, luma, pal_g, meta, use_ciede2000, pal,
+                                    chunk=8192):
+    """
+    Algorithm 2 gamma correct for an (N, 3) array of colors: the plan grows
+    greedily by the color and amount (1, 2, 4...) whose gamma-corrected
+    average is closest to the input color, every step evaluated for all the
+    colors at once. Same plans as devise_best_mixing_plan2g.
+    Return the (N, 2 * limit) array of plans sorted by luminance and their lengths.
+    """
+    srccols = np.asarray(srccols, dtype=np.int64)
+    pal_g = np.array(pal_g[:n_colors])
+
+    # p = 1, 2, 4, ... up to the largest max_test_count
+    amounts = []
+    p = 1
+    while p <= max(1, limit - 1):
+        amounts.append(p)
+        p *= 2
+    amounts = np.array(amounts)
+
+    plans = np.zeros((len(srccols), 2 * limit), dtype=np.intp)
+    lengths = np.zeros(len(srccols), dtype=np.intp)
+
+    for start in range(0, len(srccols), chunk):
+        src = srccols[start:start + chunk]
+        if use_ciede2000:
+            inputlab = rgb_to_lab(src / 255.0)
+        r_colors = plans[start:start + chunk]
+        length = lengths[start:start + chunk]
+
+        # Tally so far (gamma-corrected)
+        so_far = np.zeros((len(src), 3))
+
+        active = np.arange(len(src))
+        while len(active) > 0:
+            n = length[active]
+            max_test_count = np.maximum(1, n)
+
+            # sum and add as the scalar loops update them, for each p
+            sum = so_far[active][:, np.newaxis, :] + np.zeros_like(pal_g)[np.newaxis]
+            add = pal_g
+            sums = []
+            for p in amounts:
+                sum = sum + add
+                add = add + add
+                sums.append(sum)
+            t = n[:, np.newaxis] + amounts[np.newaxis, :]
+            test = gamma_uncorrect_array(np.stack(sums, axis=2) / t[:, np.newaxis, :, np.newaxis])
+
+            if use_ciede2000:
+                penalty = ciede2000(rgb_to_lab(test),
+                                    inputlab[active][:, np.newaxis, np.newaxis])
+            else:
+                penalty = ccir601(src[active][:, np.newaxis, np.newaxis], test * 255.0)
+            too_many = amounts[np.newaxis, :] > max_test_count[:, np.newaxis]
+            penalty = np.where(too_many[:, np.newaxis, :], np.inf, penalty)
+
+            # First (index, p) of least penalty, like the scalar loops
+            best = np.argmin(penalty.reshape(len(active), -1), axis=1)
+            chosen = best // len(amounts)
+            chosen_amount = amounts[best % len(amounts)]
+
+            # Append "chosen_amount" times "chosen" to the color list
+            for k in range(amounts[-1]):
+                some = k < chosen_amount
+                r_colors[active[some], n[some] + k] = chosen[some]
+            length[active] = n + chosen_amount
+            so_far[active] = so_far[active] + pal_g[chosen] * chosen_amount[:, np.newaxis]
+
+            active = active[length[active] < limit]
+
+    return (sort_plans_by_luma(plans, lengths, luma), lengths)
+
+
+def devise_best_mixing_plan3_batch(srccols, n_colors, limit, luma, pal_g, meta, use_ciede2000, pal,
+                                   chunk=8192):
+    """
+    Algorithm 3 for an (N, 3) array of colors: starting from the closest
+    palette color, a part of the solution is split in two colors as long as
+    it gets closer to the input color, every split of every solution
+    evaluated for all the colors at once.
+    A solution is kept as slots of (color, count) in the order of the dict.
+    Same plans as devise_best_mixing_plan3.
+    Return the (N, limit + n_colors) array of plans sorted by luminance and their lengths.
+    """
+    srccols = np.asarray(srccols, dtype=np.int64)
+    pal_g = np.array(pal_g[:n_colors])
+    pc = np.array(pal[:n_colors], dtype=np.int64)
+
+    # Color pairs a split may go to; portion1 and portion2 are always equal,
+    # the count being split in halves, hence b > a
+    pairs = np.array([(a, b) for a in range(n_colors) for b in range(a + 1, n_colors)
+                      if abs(luma[a] - luma[b]) <= 80000], dtype=np.intp).reshape(-1, 2)
+
+    plans = np.zeros((len(srccols), limit + n_colors), dtype=np.intp)
+    lengths = np.zeros(len(srccols), dtype=np.intp)
+    dbllimit = 1.0 / limit
+
+    for start in range(0, len(srccols), chunk):
+        src = srccols[start:start + chunk]
+        count = len(src)
+        if use_ciede2000:
+            inputlab = rgb_to_lab(src / 255.0)
+            penalty = ciede2000(inputlab[:, np.newaxis], meta[np.newaxis, :n_colors])
+        else:
+            penalty = ccir601(src[:, np.newaxis], pc[np.newaxis])
+
+        # First, find the closest color to the input color. It is our seed.
+        slot_color = np.zeros((count, n_colors), dtype=np.intp)
+        slot_count = np.zeros((count, n_colors))
+        slots = np.ones(count, dtype=np.intp)
+        slot_color[:, 0] = np.argmin(penalty, axis=1)
+        slot_count[:, 0] = limit
+
+        # The penalty of our currently "best" solution.
+        current_penalty = penalty.min(axis=1)
+
+        active = np.flatnonzero(current_penalty != 0.0)
+        while len(active) > 0 and len(pairs) > 0:
+            colors = slot_color[active]
+            counts = slot_count[active]
+            used = np.arange(n_colors)[np.newaxis, :] < slots[active][:, np.newaxis]
+
+            # Tally the other colors, for each slot to split
+            sum = np.zeros((len(active), n_colors, 3))
+            for j in range(n_colors):
+                term = pal_g[colors[:, j]] * counts[:, j, np.newaxis] * dbllimit
+                other = used[:, j, np.newaxis] & (np.arange(n_colors) != j)[np.newaxis, :]
+                sum = np.where(other[:, :, np.newaxis], sum + term[:, np.newaxis, :], sum)
+
+            portion = ((counts / 2.0) * dbllimit)[:, :, np.newaxis, np.newaxis]
+            test = gamma_uncorrect_array(sum[:, :, np.newaxis, :]
+                                         + pal_g[pairs[:, 0]][np.newaxis, np.newaxis] * portion
+                                         + pal_g[pairs[:, 1]][np.newaxis, np.newaxis] * portion)
+
+            # Figure out if a split is better than what we had
+            if use_ciede2000:
+                penalty = ciede2000(inputlab[active][:, np.newaxis, np.newaxis],
+                                    rgb_to_lab(test))
+            else:
+                penalty = ccir601(src[active][:, np.newaxis, np.newaxis], test * 255)
+            penalty[~used] = np.inf
+
+            best = np.argmin(penalty.reshape(len(active), -1), axis=1)
+            best_penalty = penalty.reshape(len(active), -1)[np.arange(len(active)), best]
+            better = best_penalty < current_penalty[active]
+
+            # No better solution was found for the others.
+            active = active[better]
+            best = best[better]
+            best_splitfrom = best // len(pairs)
+            split_to = pairs[best % len(pairs)]
+            current_penalty[active] = best_penalty[better]
+
+            split_count = slot_count[active, best_splitfrom]
+            split1 = split_count / 2.0
+            split2 = split_count - split1
+
+            # del solution[best_splitfrom]
+            for j in range(n_colors - 1):
+                shift = j >= best_splitfrom
+                slot_color[active[shift], j] = slot_color[active[shift], j + 1]
+                slot_count[active[shift], j] = slot_count[active[shift], j + 1]
+            slots[active] -= 1
+
+            for split, to in ((split1, split_to[:, 0]), (split2, split_to[:, 1])):
+                used = np.arange(n_colors)[np.newaxis, :] < slots[active][:, np.newaxis]
+                found = used & (slot_color[active] == to[:, np.newaxis])
+                there = found.any(axis=1)
+                where = np.where(there, np.argmax(found, axis=1), slots[active])
+                slot_color[active, where] = to
+                slot_count[active, where] = np.where(there, slot_count[active, where], 0.0) + split
+                slots[active] += ~there
+
+            active = active[current_penalty[active] != 0.0]
+
+        # Sequence the solution.
+        r_colors = plans[start:start + chunk]
+        length = np.zeros(count, dtype=np.intp)
+        for j in range(n_colors):
+            size = length + slot_count[:, j]
+            new_length = np.where(j < slots, np.maximum(length, np.ceil(size)), length)
+            new_length = new_length.astype(np.intp)
+            for k in range(int(np.max(new_length - length, initial=0))):
+                some = length + k < new_length
+                r_colors[np.flatnonzero(some), length[some] + k] = slot_color[some, j]
+            length = new_length
+        lengths[start:start + chunk] = length
+
+    return (sort_plans_by_luma(plans, lengths, luma), lengths)
+
+
+def plan2g_positions(colors, mode, dmap, d_range, ciede2000, pal):
+    """ Palette index for each dither matrix position, modes 6 and 7. """
+    n_colors = len(pal)
+    luma = [(r * 299 + g * 587 + b * 114) for r, g, b in pal]
+    pal_g = gamma_palette(pal)
+    meta = rgb_to_lab(np.array(pal) / 255.0)
+    mix_plan = {
+        6: devise_best_mixing_plan2g_batch,
+        7: devise_best_mixing_plan3_batch
+    }
+    plans, lengths = mix_plan[mode](colors, n_colors, n_colors, luma, pal_g, meta, ciede2000, pal)
+    map_values = np.array([v for row in dmap for v in row])
+    index = map_values[np.newaxis, :] * lengths[:, np.newaxis] // d_range
+    return np.take_along_axis(plans, index, axis=1)
+
+
 def devise_best_mixing_plan4(srccol, n_colors, limit, luma, d_range, pal):
     r_colors = [0] * d_range
     src = list(srccol)
@@ -877,45 +1404,132 @@ def devise_best_mixing_plan4(srccol, n_colors, limit, luma, d_range, pal):
     return cols
 
 
-def convert_dither(srcim, mode, dither, ciede2000, pal):
-    w, h = srcim.size
-    im = Image.new("RGB", (w, h))
-    src = srcim.load()
-    dst = im.load()
+def devise_best_mixing_plan4_batch(srccols, n_colors, limit, luma, d_range, pal):
+    """
+    devise_best_mixing_plan4 for an (N, 3) array of colors.
+    Return an (N, d_range) array of palette indexes sorted by luminance.
+    """
+    src = np.asarray(srccols, dtype=np.int64)
+    pc = np.array(pal[:n_colors], dtype=np.int64)
+    pc_luma = (pc[:, 0] * 299 + pc[:, 1] * 587 + pc[:, 2] * 114) / (255.0 * 1000.0)
+    lx = 0.09   # Error multiplier
+    e = np.zeros_like(src)   # Error accumulator
+    r_colors = np.zeros((len(src), d_range), dtype=np.int64)
 
-    dmap = dithermaps[dither]
+    for c in range(d_range):
+        # Current temporary value, clamped in the allowed RGB range
+        t = np.clip(np.trunc(src + e * lx), 0, 255).astype(np.int64)
+
+        # Find the closest color from the palette
+        # (same operations as color_compare_ccir601(pc, t), row by row)
+        luma2 = (t[:, 0] * 299 + t[:, 1] * 587 + t[:, 2] * 114) / (255.0 * 1000.0)
+        lumad = pc_luma[np.newaxis, :] - luma2[:, np.newaxis]
+        r = (pc[np.newaxis, :, 0] - t[:, np.newaxis, 0]) / 255.0
+        g = (pc[np.newaxis, :, 1] - t[:, np.newaxis, 1]) / 255.0
+        b = (pc[np.newaxis, :, 2] - t[:, np.newaxis, 2]) / 255.0
+        penalty = (r * r * 0.299 + g * g * 0.587 + b * b * 0.114) * 0.75 + lumad * lumad
+        chosen = np.argmin(penalty, axis=1)
+
+        # Add it to candidates and update the error
+        r_colors[:, c] = chosen
+        e += src - pc[chosen]
+
+    # Sort the colors according to luminance (stable, like sorted())
+    order = np.argsort(np.array(luma)[r_colors], axis=1, kind="stable")
+    return np.take_along_axis(r_colors, order, axis=1)
+
+
+def plan4_positions(colors, mode, dmap, d_range, ciede2000, pal):
+    """ Palette index for each dither matrix position, mode 8. """
+    luma = [(r * 299 + g * 587 + b * 114) for r, g, b in pal]
+    cols = devise_best_mixing_plan4_batch(colors, len(pal), len(pal), luma, d_range, pal)
+    map_values = [v for row in dmap for v in row]
+    return cols[:, map_values]
+
+
+def plan1_positions(colors, mode, dmap, d_range, ciede2000, pal):
+    """ Palette index for each dither matrix position, modes 0, 1 and 2. """
+    r_colors, r_ratio = devise_best_mixing_plan_batch(colors, mode, d_range, pal)
+    map_values = np.array([v for row in dmap for v in row])
+    threshold = (map_values / d_range)[np.newaxis, :] < r_ratio[:, np.newaxis]
+    return np.where(threshold, r_colors[:, 1:2], r_colors[:, 0:1])
+
+
+# Modes whose mixing plans are computed for whole arrays of colors,
+# fast enough to be precomputed for the whole RGB cube.
+plan_table_engines = {
+    0: plan1_positions,
+    1: plan1_positions,
+    2: plan1_positions,
+    6: plan2g_positions,
+    7: plan2g_positions,
+    8: plan4_positions,
+    9: plan2t_positions,
+}
+
+
+def plan_table_path(directory, mode, dither, d_range, ciede2000, pal):
+    # CIEDE2000 only changes the plans of modes 6, 7 and 9
+    ciede2000 = bool(ciede2000) and mode in (6, 7, 9)
+    key = repr((mode, dither, d_range, ciede2000, [tuple(c) for c in pal]))
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(directory, "plan_m%d_d%d_%s.npy" % (mode, dither, digest))
+
+
+def build_plan_table(path, mode, dmap, d_range, ciede2000, pal):
+    """
+    Compute the palette index of every RGB value at every dither matrix
+    position: a (2**24, dh * dw) uint8 array saved as .npy.
+    """
+    engine = plan_table_engines[mode]
+    positions = len(dmap) * len(dmap[0])
+    tmp_path = path + ".tmp"
+    table = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8,
+                                      shape=(1 << 24, positions))
+    chunk = 1 << 16
+    for start in tqdm(range(0, 1 << 24, chunk), ascii=True):
+        code = np.arange(start, start + chunk)
+        colors = np.stack([code >> 16, (code >> 8) & 0xff, code & 0xff], axis=1)
+        table[start:start + chunk] = engine(colors, mode, dmap, d_range, ciede2000, pal)
+    table.flush()
+    del table
+    os.replace(tmp_path, path)
+
+
+def load_plan_table(directory, mode, dither, d_range, ciede2000, pal):
+    """ Memory-map the plan table, building it on first use. """
+    if mode not in plan_table_engines:
+        print("Error: No plan table for mode = %d" % mode)
+        sys.exit()
+    if len(pal) > 256:
+        print("Error: Plan tables hold at most 256 colors")
+        sys.exit()
+
+    path = plan_table_path(directory, mode, dither, d_range, ciede2000, pal)
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        print("Building plan table %s" % path)
+        build_plan_table(path, mode, dithermaps[dither], d_range, ciede2000, pal)
+    return np.load(path, mmap_mode="r")
+
+
+def dither_positions(w, h, dmap):
+    """ Dither matrix position (row-major) of every pixel of the frame. """
     dh = len(dmap)
     dw = len(dmap[0])
-    # d_range = dw * dh  # dither level range
-    # 24
-    d_range = 8
+    return (np.arange(h) % dh)[:, np.newaxis] * dw + (np.arange(w) % dw)[np.newaxis, :]
 
-    # 48
-    # d_range = 32
 
-    if 0 <= mode <= 4:
-        # algorithm 1
-        mix_plan = {
-            0: devise_best_mixing_plan,
-            1: devise_best_mixing_plan,
-            2: devise_best_mixing_plan,
-            3: devise_best_mixing_plan_fast,
-            4: devise_best_mixing_plan_tritone,
-        }
+def dither_with_plan_table(srcim, table, dmap, pal):
+    src = np.asarray(srcim.convert("RGB"), dtype=np.int32)
+    h, w = src.shape[:2]
+    code = (src[:, :, 0] << 16) | (src[:, :, 1] << 8) | src[:, :, 2]
+    index = table[code, dither_positions(w, h, dmap)]
+    return Image.fromarray(np.array(pal, dtype=np.uint8)[index])
 
-        for y in tqdm(range(h), ascii=True):
-            for x in range(w):
-                cols, ratio = mix_plan[mode](src[x, y], mode, d_range, pal)
-                if mode == 4 and ratio == 4.0:
-                    # Tri-tone or quad-tone dithering
-                    dst[x, y] = pal[cols[(y % 2) * 2 + (x % 2)]]
-                else:
-                    if (dmap[y % dh][x % dw] / d_range) < ratio:
-                        dst[x, y] = pal[cols[1]]
-                    else:
-                        dst[x, y] = pal[cols[0]]
-        return im
 
+def devise_function(mode, d_range, ciede2000, pal):
+    """ Mixing plan function of this mode, and its arguments after the color. """
     # get palette length
     n_colors = len(pal)
 
@@ -923,77 +1537,168 @@ def convert_dither(srcim, mode, dither, ciede2000, pal):
     # to be initialized as soon as the program begins
     luma = [(r * 299 + g * 587 + b * 114) for r, g, b in pal]
 
-    if mode == 5:
+    if 0 <= mode <= 4:
+        # algorithm 1
+        mix_plan = {
+            0: devise_best_mixing_plan,
+            1: devise_best_mixing_plan,
+            2: devise_best_mixing_plan,
+            3: devise_best_mixing_plan_fast,
+            4: devise_best_mixing_plan_tritone,
+        }
+        plan_function = mix_plan[mode]
+        args = (mode, d_range, pal)
+    elif mode == 5:
         # algorithm 2
-        for y in tqdm(range(h), ascii=True):
-            for x in range(w):
-                cols = devise_best_mixing_plan2(src[x, y], n_colors, luma, pal)
-                map_value = int(dmap[y % dh][x % dw] * n_colors // d_range)
-                dst[x, y] = pal[cols[map_value]]
-
-        return im
-
-    if mode == 6 or mode == 7:
+        plan_function = devise_best_mixing_plan2
+        args = (n_colors, luma, pal)
+    elif mode == 6 or mode == 7:
         # algorithm 2 gamma correct / algorithm 3
-        pal_g = []
-        meta = []
-        for r, g, b in pal:
-            gr = gamma_correct(r / 255.0)
-            gg = gamma_correct(g / 255.0)
-            gb = gamma_correct(b / 255.0)
-            pal_g.append([gr, gg, gb])
-            meta.append(LabItem(r, g, b, 255.0))
+        pal_g = gamma_palette(pal)
+        # Lab value of each palette entry
+        meta = rgb_to_lab(np.array(pal) / 255.0)
 
         mix_plan = {
             6: devise_best_mixing_plan2g,
             7: devise_best_mixing_plan3
         }
+        plan_function = mix_plan[mode]
+        args = (n_colors, n_colors, luma, pal_g, meta, ciede2000, pal)
+    elif mode == 8:
+        # adobe like pattern dither
+        plan_function = devise_best_mixing_plan4
+        args = (n_colors, n_colors, luma, d_range, pal)
+    elif mode == 9:
+        # algorithm 2 gamma correct, nearest of all the reachable mixtures
+        plan_function = devise_best_mixing_plan2t
+        args = (MixTable(n_colors, luma, gamma_palette(pal), ciede2000, pal),)
+    else:
+        print("Error: Unknown mode = %d" % mode)
+        sys.exit()
 
-        for y in tqdm(range(h), ascii=True):
-            for x in range(w):
-                cols = mix_plan[mode](src[x, y],
-                                      n_colors, n_colors,
-                                      luma, pal_g, meta,
-                                      ciede2000, pal)
-                map_value = int(dmap[y % dh][x % dw] * len(cols) // d_range)
-                dst[x, y] = pal[cols[map_value]]
+    return plan_function, args
 
-        return im
 
-    if mode == 8:
-        # adobe like pattern dither
-        for y in tqdm(range(h), ascii=True):
-            for x in range(w):
-                cols = devise_best_mixing_plan4(src[x, y],
-                                                n_colors, n_colors,
-                                                luma, d_range, pal)
-                map_value = dmap[y % dh][x % dw]
-                dst[x, y] = pal[cols[map_value]]
+def plan_row(plan, mode, dmap, d_range, n_colors):
+    """ Palette index given by a mixing plan at every dither matrix position. """
+    row = []
+    for y in range(len(dmap)):
+        for x in range(len(dmap[0])):
+            row.append(plan_index(plan, mode, dmap[y][x], x, y, d_range, n_colors))
+    return row
+
+
+def dither_unique_colors(srcim, plan, mode, dmap, d_range, ciede2000, pal):
+    """
+    Compute one mixing plan per distinct color of the image,
+    then spread the plans over the frame.
+    """
+    src = np.asarray(srcim.convert("RGB"))
+    h, w = src.shape[:2]
+    colors, inverse = np.unique(src.reshape(-1, 3), axis=0, return_inverse=True)
+
+    if mode in plan_table_engines:
+        # all the plans at once
+        rows = plan_table_engines[mode](colors, mode, dmap, d_range, ciede2000, pal)
+    else:
+        rows = np.zeros((len(colors), len(dmap) * len(dmap[0])), dtype=np.intp)
+        for k, col in enumerate(tqdm(colors.tolist(), ascii=True)):
+            rows[k] = plan_row(plan(tuple(col)), mode, dmap, d_range, len(pal))
+
+    index = rows[inverse.reshape(h, w), dither_positions(w, h, dmap)]
+    return Image.fromarray(np.array(pal, dtype=np.uint8)[index])
+
+
+def convert_dither(srcim, mode, dither, ciede2000, pal, plan_table=None, cache=None,
+                   unique=False, jobs=1):
+    w, h = srcim.size
+    im = Image.new("RGB", (w, h))
+    src = srcim.load()
+    dst = im.load()
+
+    dmap = dithermaps[dither]
+    dh = len(dmap)
+    dw = len(dmap[0])
+    # d_range = dw * dh  # dither level range
+    # 24
+    d_range = 8
+
+    # 48
+    # d_range = 32
+
+    if plan_table is not None:
+        # precomputed plans, memory-mapped
+        table = load_plan_table(plan_table, mode, dither, d_range, ciede2000, pal)
+        return dither_with_plan_table(srcim, table, dmap, pal)
+
+    plan = mixing_plan_function(devise_function, mode, d_range, ciede2000, pal, cache)
+
+    if unique:
+        # one plan per distinct color
+        return dither_unique_colors(srcim, plan, mode, dmap, d_range, ciede2000, pal)
+
+    if jobs > 1:
+        # row bands on several processes, batched by the engine of the mode if any
+        engine = plan_table_engines.get(mode)
+        return dither_bands(srcim, devise_function, engine, mode, dmap, d_range, ciede2000,
+                            pal, cache, jobs)
+
+    n_colors = len(pal)
+    for y in tqdm(range(h), ascii=True):
+        for x in range(w):
+            index = plan_index(plan(src[x, y]), mode, dmap[y % dh][x % dw],
+                               x, y, d_range, n_colors)
+            dst[x, y] = pal[index]
 
     return im
 
 
 def main():
-    if len(sys.argv) <= 2:
-        print("")
-        print("I need the following arguments:")
-        print("  * a picture filename")
-        print("  * a gamma correction (eg. 0.8 clearer, 1.2 darker)")
-        print("")
-        exit()
-    
-    im = Image.open(sys.argv[1])
+    parser = argparse.ArgumentParser(description="Yliluoma ordered dithering for the VG5000")
+    parser.add_argument("picture", help="picture filename")
+    parser.add_argument("gamma", type=float,
+                        help="gamma correction (eg. 0.8 clearer, 1.2 darker)")
+    parser.add_argument("-m", "--mode", type=int, default=8,
+                        help="mixing plan mode 0 - 9. default: 8")
+    parser.add_argument("-c", "--ciede2000", action="store_true",
+                        help="enable CIEDE2000 (mode 6, 7 and 9)")
+    parser.add_argument("-t", "--plan-table",
+                        help="directory of the precomputed mixing plan tables (modes 0, 1, 2, 6, 7, 8, 9). "
+                             "A missing table is built first, on one core: a few minutes for modes "
+                             "0, 1, 2, 8 and 9, 0.5 h for mode 6, 2 h for mode 7, and with -c "
+                             "2 h for mode 6, 4 h for mode 9, 8 h for mode 7")
+    parser.add_argument("-C", "--plan-cache", type=int, default=0,
+                        help="keep up to N mixing plans in a LRU cache (default: 0, off)")
+    parser.add_argument("-u", "--unique", action="store_true",
+                        help="compute one mixing plan per distinct color")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="dither row bands on N processes (default: 1)")
+    args = parser.parse_args()
+
+    # the plan table replaces the plan computation, these options would be ignored
+    if args.plan_table is not None and (args.plan_cache > 0 or args.unique or args.jobs > 1):
+        parser.error("--plan-table cannot be combined with --plan-cache, --unique or --jobs")
+
+    im = Image.open(args.picture)
     im = im.convert("RGB")
 
     # gamma ?
-    g = float(sys.argv[2])
+    g = args.gamma
     print(g)
     im = im.point(lambda x: ((x/255)**g)*255)
     im.save("im_gamma.png")
 
-    im = convert_dither(im, 8, 24, "store_true", pal)
+    cache = None
+    if args.plan_cache > 0:
+        cache = PlanCache(args.plan_cache)
+
+    im = convert_dither(im, args.mode, 24, args.ciede2000, pal, args.plan_table, cache,
+                        args.unique, args.jobs)
     im.save("im_ordered.png")
 
+    if cache is not None:
+        print(cache.stats())
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,191 @@
+#!python
+# -*- mode: python; Encoding: utf-8; coding: utf-8 -*-
+"""
+Mixing plan helpers shared by yliluoma.py and ditherTo8ColorsY.py
+
+LRU cache of mixing plans, palette index given by a plan at a pixel,
+and the row band dithering on a process pool.
+
+Each script passes its own devise_function(mode, d_range, ciede2000, pal),
+which returns the plan function of the mode and its arguments after the color.
+A script may also pass an engine(colors, mode, dmap, d_range, ciede2000, pal),
+giving the palette index at every dither matrix position for an (N, 3) array
+of colors; the bands are then dithered one plan per distinct color.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from PIL import Image
+from tqdm import tqdm
+import collections
+import numpy as np
+import os
+
+
+class PlanCache:
+    """ Bounded LRU cache of mixing plans, keyed by source color. """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.plans = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # entries of the caches of the band processes
+        self.worker_entries = 0
+
+    def get(self, key, plan_function, args):
+        if key in self.plans:
+            self.hits += 1
+            self.plans.move_to_end(key)
+            return self.plans[key]
+
+        self.misses += 1
+        plan = plan_function(*args)
+        self.plans[key] = plan
+        if len(self.plans) > self.max_entries:
+            self.plans.popitem(last=False)
+        return plan
+
+    def stats(self):
+        total = self.hits + self.misses
+        rate = 100.0 * self.hits / total if total > 0 else 0.0
+        return "Plan cache: %d hits, %d misses (%.1f%%), %d entries" % (
+            self.hits, self.misses, rate, len(self.plans) + self.worker_entries)
+
+
+def palette_id(pal):
+    return hash(tuple(tuple(c) for c in pal))
+
+
+def mixing_plan_function(devise_function, mode, d_range, ciede2000, pal, cache=None):
+    """ Return the function giving the mixing plan of one color in this mode. """
+    plan_function, args = devise_function(mode, d_range, ciede2000, pal)
+
+    # CIEDE2000 only changes the plans of modes 6, 7 and 9
+    pal_key = (mode, d_range, palette_id(pal), bool(ciede2000) and mode in (6, 7, 9))
+
+    def plan(col):
+        if cache is None:
+            return plan_function(col, *args)
+        return cache.get((col,) + pal_key, plan_function, (col,) + args)
+
+    return plan
+
+
+def plan_index(plan, mode, map_value, x, y, d_range, n_colors):
+    """ Palette index given by a mixing plan at pixel (x, y). """
+    if 0 <= mode <= 4:
+        cols, ratio = plan
+        if mode == 4 and ratio == 4.0:
+            # Tri-tone or quad-tone dithering
+            return cols[(y % 2) * 2 + (x % 2)]
+        if (map_value / d_range) < ratio:
+            return cols[1]
+        return cols[0]
+
+    if mode == 5:
+        return plan[int(map_value * n_colors // d_range)]
+
+    if mode == 6 or mode == 7 or mode == 9:
+        return plan[int(map_value * len(plan) // d_range)]
+
+    return plan[map_value]
+
+
+# State of a band dithering process, set once by init_band_worker
+band_worker = {}
+
+
+def init_band_worker(devise_function, engine, mode, d_range, ciede2000, pal, cache_entries,
+                     src_name, dst_name):
+    band_worker["engine"] = engine
+    band_worker["ciede2000"] = ciede2000
+    band_worker["pal"] = pal
+    cache = None
+    if cache_entries > 0:
+        cache = PlanCache(cache_entries)
+    band_worker["cache"] = cache
+    band_worker["plan"] = mixing_plan_function(devise_function, mode, d_range, ciede2000,
+                                               pal, cache)
+    band_worker["src"] = shared_memory.SharedMemory(name=src_name)
+    band_worker["dst"] = shared_memory.SharedMemory(name=dst_name)
+
+
+def dither_band(y0, y1, w, h, mode, dmap, d_range, n_colors):
+    """
+    Palette indexes of rows y0 to y1 of the shared frame, as the serial loop does.
+    Return the plan cache hits and misses of the band, the process id and
+    the entries of its cache.
+    """
+    src = np.ndarray((h, w, 3), dtype=np.uint8, buffer=band_worker["src"].buf)
+    dst = np.ndarray((h, w), dtype=np.uint16, buffer=band_worker["dst"].buf)
+    dh = len(dmap)
+    dw = len(dmap[0])
+
+    engine = band_worker["engine"]
+    if engine is not None:
+        # all the plans of the band at once, one per distinct color
+        colors, inverse = np.unique(src[y0:y1].reshape(-1, 3), axis=0, return_inverse=True)
+        rows = engine(colors, mode, dmap, d_range, band_worker["ciede2000"], band_worker["pal"])
+        positions = ((np.arange(y0, y1) % dh)[:, np.newaxis] * dw
+                     + (np.arange(w) % dw)[np.newaxis, :])
+        dst[y0:y1] = rows[inverse.reshape(y1 - y0, w), positions]
+        return (0, 0, os.getpid(), 0)
+
+    plan = band_worker["plan"]
+    cache = band_worker["cache"]
+    if cache is not None:
+        hits, misses = cache.hits, cache.misses
+
+    for y in range(y0, y1):
+        row = src[y].tolist()
+        dst[y] = [plan_index(plan(tuple(row[x])), mode, dmap[y % dh][x % dw],
+                             x, y, d_range, n_colors)
+                  for x in range(w)]
+
+    if cache is None:
+        return (0, 0, os.getpid(), 0)
+    return (cache.hits - hits, cache.misses - misses, os.getpid(), len(cache.plans))
+
+
+def dither_bands(srcim, devise_function, engine, mode, dmap, d_range, ciede2000, pal, cache, jobs):
+    """
+    The serial loop of convert_dither, run on row bands by jobs processes.
+    With an engine, each band is dithered one plan per distinct color instead.
+    The source frame and the palette indexes are shared, not pickled.
+    """
+    src = np.asarray(srcim.convert("RGB"))
+    h, w = src.shape[:2]
+    src_shm = shared_memory.SharedMemory(create=True, size=max(1, src.nbytes))
+    dst_shm = shared_memory.SharedMemory(create=True, size=max(1, h * w * 2))
+    try:
+        np.ndarray(src.shape, dtype=np.uint8, buffer=src_shm.buf)[:] = src
+
+        # A few bands per process, each a whole number of dither matrix heights
+        dh = len(dmap)
+        band = max(1, -(-h // (jobs * 4 * dh))) * dh
+        cache_entries = 0 if cache is None else cache.max_entries
+
+        with ProcessPoolExecutor(jobs, initializer=init_band_worker,
+                                 initargs=(devise_function, engine, mode, d_range, ciede2000, pal,
+                                           cache_entries, src_shm.name, dst_shm.name)) as pool:
+            futures = [pool.submit(dither_band, y0, min(h, y0 + band), w, h,
+                                   mode, dmap, d_range, len(pal))
+                       for y0 in range(0, h, band)]
+            entries = {}
+            for future in tqdm(as_completed(futures), total=len(futures), ascii=True):
+                hits, misses, pid, entries[pid] = future.result()
+                if cache is not None:
+                    cache.hits += hits
+                    cache.misses += misses
+            if cache is not None:
+                cache.worker_entries += sum(entries.values())
+
+        index = np.ndarray((h, w), dtype=np.uint16, buffer=dst_shm.buf).copy()
+    finally:
+        src_shm.close()
+        src_shm.unlink()
+        dst_shm.close()
+        dst_shm.unlink()
+
+    return Image.fromarray(np.array(pal, dtype=np.uint8)[index])
@@ -0,0 +1,106 @@
+"""
+Regression tests of convertToZ8.
+
+Run from the repository root: python -m unittest discover tests
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import convertToZ8
+
+PALETTE = np.array(convertToZ8.VG5K_COLORS, dtype=np.uint8)
+WHITE, CYAN, BLUE, RED, BLACK = 0, 1, 3, 6, 7
+
+
+def mosaic_cell(background, ink, sixels):
+	# cellule 4*10 d'indices VG5K_COLORS, encre sur les sixels
+	# (bit 2 * ligne + colonne, lignes de 3, 4 et 3 pixels)
+	cell = np.full((10, 4), background)
+	for row, (y0, y1) in enumerate(((0, 3), (3, 7), (7, 10))):
+		for col in range(2):
+			if sixels & (1 << (row * 2 + col)):
+				cell[y0:y1, 2 * col:2 * col + 2] = ink
+	return cell
+
+
+def convert_frame(cells, *options):
+	# convertToZ8 sur une ligne de cellules : (asm, bin)
+	with tempfile.TemporaryDirectory() as tmp:
+		picture = os.path.join(tmp, "frame.png")
+		Image.fromarray(PALETTE[np.hstack(cells)]).save(picture)
+		asm_name = os.path.join(tmp, "frame.asm")
+		bin_name = os.path.join(tmp, "frame.bin")
+		convertToZ8.main(["convertToZ8.py", *options, "-o", asm_name, picture])
+		convertToZ8.main(["convertToZ8.py", *options, "--format", "bin", "-o", bin_name, picture])
+		with open(asm_name) as f:
+			asm = f.read()
+		with open(bin_name, "rb") as f:
+			binary = f.read()
+	return asm, binary
+
+
+def loader_of(binary):
+	main_adr = binary[1] | binary[2] << 8
+	return binary[main_adr - convertToZ8.ORG_ADR:]
+
+
+class MosaicTest(unittest.TestCase):
+
+	def test_g10_layout(self):
+		# sixels de 3, 4 et 3 lignes, codes 1 2 / 4 8 / 16 64 a partir de $20
+		table = convertToZ8.get_mosaic_table()
+		self.assertEqual(len(table), 64)
+
+		def code(sixels):
+			glyph = mosaic_cell(0, 1, sixels) == 1
+			return table[np.packbits(glyph).tobytes()]
+
+		self.assertEqual(code(0), 0x20)
+		self.assertEqual([code(1 << bit) for bit in range(6)], [0x21, 0x22, 0x24, 0x28, 0x30, 0x60])
+		self.assertEqual(code(63), 0x7f)
+
+	def test_sprite_use_codes_and_attributes(self):
+		cells = [
+			mosaic_cell(RED, CYAN, 0b100000),	# sixel bas droit
+			mosaic_cell(BLACK, WHITE, 0b000110),	# haut droit, milieu gauche (lignes 3 a 6)
+			mosaic_cell(BLUE, BLUE, 0),	# uni
+		]
+		asm, binary = convert_frame(cells, "--rom-mosaic")
+		# R3 = encre << 4 | fond, en couleurs EF9345 (7 - indice VG5K_COLORS)
+		expected = bytes([
+			0x60, convertToZ8.MOSAIC_R2, (7 - CYAN) << 4 | (7 - RED),
+			0x26, convertToZ8.MOSAIC_R2, (7 - WHITE) << 4 | (7 - BLACK),
+			0x20, convertToZ8.MOSAIC_R2, (7 - BLUE) << 4 | (7 - BLUE),
+		])
+		self.assertEqual(binary[4:4 + len(expected)], expected)
+		self.assertIn("- Mosaique G10  $60", asm)
+		self.assertIn("db  $60 , $21 , $61", asm)
+
+	def test_all_mosaic_frame_does_not_call_redef_cars(self):
+		# 0 tampon : djnz ferait 256 tours dans redef_cars
+		asm, binary = convert_frame([mosaic_cell(BLACK, WHITE, 0b001001)] * 2, "--rom-mosaic")
+		self.assertIn("ld de, 0 ; tampons", asm)
+		self.assertNotIn("call redef_cars", asm)
+		self.assertEqual(len(binary), 4 + 2 * 3 + len(convertToZ8.LOADER_BIN))
+		loader = loader_of(binary)
+		self.assertEqual(loader[convertToZ8.LOADER_REDEF_CARS:convertToZ8.LOADER_REDEF_CARS + 3], bytes(3))
+
+	def test_redef_cars_called_with_tampons(self):
+		rng = np.random.default_rng(0)
+		cells = [mosaic_cell(BLACK, WHITE, 0b001001), rng.choice([WHITE, RED, BLUE], (10, 4))]
+		asm, binary = convert_frame(cells, "--rom-mosaic")
+		self.assertIn("call redef_cars", asm)
+		loader = loader_of(binary)
+		self.assertEqual(loader[convertToZ8.LOADER_REDEF_CARS], 0xcd)
+		self.assertEqual(int.from_bytes(loader[convertToZ8.LOADER_TAMPONS:convertToZ8.LOADER_TAMPONS + 2], "little"), 1)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -8,7 +8,7 @@ Arbitrary-palette positional dithering algorithm
 https://bisqwit.iki.fi/story/howto/dither/jy/
 
 Usage:
-    py ThisScript.py -i INPUT.png -o OUTPUT.png [-m num] [-d num] [-c] [-p PALETTE]
+    py ThisScript.py -i INPUT.png -o OUTPUT.png [-m num] [-d num] [-c] [-p PALETTE] [-C N] [-j num]
 
 -m num, --mode num : 0-5
                      0=1a, 1=1ba, 2=1bb,
@@ -22,6 +22,8 @@ Usage:
 -d num, --dither num : 2 or 4 or 8 (Dither 2x2, 4x4, 8x8)
 -c, --ciede2000 : enable CIEDE2000 (mode 6 and 7)
 -p PALETTE, --palette PALETTE : Palette file (.png or .gpl)
+-C N, --plan-cache N : keep up to N mixing plans in a LRU cache
+-j num, --jobs num : dither row bands on num processes
 
 Windows10 x64 21H2 + Python 3.9.13 64bit
 """
@@ -35,6 +37,8 @@ import copy
 import math
 import re
 
+from mixingPlans import PlanCache, mixing_plan_function, plan_index, dither_bands
+
 gamma = 2.2  # Gamma correction we use.
 
 dithermaps = {
@@ -865,16 +869,14 @@ def devise_best_mixing_plan4(srccol, n_colors, limit, luma, d_range, pal):
     return cols
 
 
-def convert_dither(srcim, mode, dither, ciede2000, pal):
-    w, h = srcim.size
-    im = Image.new("RGB", (w, h))
-    src = srcim.load()
-    dst = im.load()
+def devise_function(mode, d_range, ciede2000, pal):
+    """ Mixing plan function of this mode, and its arguments after the color. """
+    # get palette length
+    n_colors = len(pal)
 
-    dmap = dithermaps[dither]
-    dh = len(dmap)
-    dw = len(dmap[0])
-    d_range = dw * dh  # dither level range
+    # Luminance for each palette entry,
+    # to be initialized as soon as the program begins
+    luma = [(r * 299 + g * 587 + b * 114) for r, g, b in pal]
 
     if 0 <= mode <= 4:
         # algorithm 1
@@ -885,38 +887,13 @@ def convert_dither(srcim, mode, dither, ciede2000, pal):
             3: devise_best_mixing_plan_fast,
             4: devise_best_mixing_plan_tritone,
         }
-
-        for y in tqdm(range(h), ascii=True):
-            for x in range(w):
-                cols, ratio = mix_plan[mode](src[x, y], mode, d_range, pal)
-                if mode == 4 and ratio == 4.0:
-                    # Tri-tone or quad-tone dithering
-                    dst[x, y] = pal[cols[(y % 2) * 2 + (x % 2)]]
-                else:
-                    if (dmap[y % dh][x % dw] / d_range) < ratio:
-                        dst[x, y] = pal[cols[1]]
-                    else:
-                        dst[x, y] = pal[cols[0]]
-        return im
-
-    # get palette length
-    n_colors = len(pal)
-
-    # Luminance for each palette entry,
-    # to be initialized as soon as the program begins
-    luma = [(r * 299 + g * 587 + b * 114) for r, g, b in pal]
-
-    if mode == 5:
+        plan_function = mix_plan[mode]
+        args = (mode, d_range, pal)
+    elif mode == 5:
         # algorithm 2
-        for y in tqdm(range(h), ascii=True):
-            for x in range(w):
-                cols = devise_best_mixing_plan2(src[x, y], n_colors, luma, pal)
-                map_value = int(dmap[y % dh][x % dw] * n_colors // d_range)
-                dst[x, y] = pal[cols[map_value]]
-
-        return im
-
-    if mode == 6 or mode == 7:
+        plan_function = devise_best_mixing_plan2
+        args = (n_colors, luma, pal)
+    elif mode == 6 or mode == 7:
         # algorithm 2 gamma correct / algorithm 3
         pal_g = []
         meta = []
@@ -931,27 +908,44 @@ def convert_dither(srcim, mode, dither, ciede2000, pal):
             6: devise_best_mixing_plan2g,
             7: devise_best_mixing_plan3
         }
+        plan_function = mix_plan[mode]
+        args = (n_colors, n_colors, luma, pal_g, meta, ciede2000, pal)
+    elif mode == 8:
+        # adobe like pattern dither
+        plan_function = devise_best_mixing_plan4
+        args = (n_colors, n_colors, luma, d_range, pal)
+    else:
+        print("Error: Unknown mode = %d" % mode)
+        sys.exit()
 
-        for y in tqdm(range(h), ascii=True):
-            for x in range(w):
-                cols = mix_plan[mode](src[x, y],
-                                      n_colors, n_colors,
-                                      luma, pal_g, meta,
-                                      ciede2000, pal)
-                map_value = int(dmap[y % dh][x % dw] * len(cols) // d_range)
-                dst[x, y] = pal[cols[map_value]]
+    return plan_function, args
 
-        return im
 
-    if mode == 8:
-        # adobe like pattern dither
-        for y in tqdm(range(h), ascii=True):
-            for x in range(w):
-                cols = devise_best_mixing_plan4(src[x, y],
-                                                n_colors, n_colors,
-                                                luma, d_range, pal)
-                map_value = dmap[y % dh][x % dw]
-                dst[x, y] = pal[cols[map_value]]
+def convert_dither(srcim, mode, dither, ciede2000, pal, cache=None, jobs=1):
+    w, h = srcim.size
+
+    dmap = dithermaps[dither]
+    dh = len(dmap)
+    dw = len(dmap[0])
+    d_range = dw * dh  # dither level range
+
+    if jobs > 1:
+        # row bands on several processes
+        return dither_bands(srcim, devise_function, None, mode, dmap, d_range, ciede2000,
+                            pal, cache, jobs)
+
+    im = Image.new("RGB", (w, h))
+    src = srcim.load()
+    dst = im.load()
+
+    plan = mixing_plan_function(devise_function, mode, d_range, ciede2000, pal, cache)
+
+    n_colors = len(pal)
+    for y in tqdm(range(h), ascii=True):
+        for x in range(w):
+            index = plan_index(plan(src[x, y]), mode, dmap[y % dh][x % dw],
+                               x, y, d_range, n_colors)
+            dst[x, y] = pal[index]
 
     return im
 
@@ -967,6 +961,10 @@ def main():
                         help="job kind 0 - 8. default: 3")
     parser.add_argument("-c", "--ciede2000", action="store_true",
                         help="Enable CIEDE2000 (mode 6 only")
+    parser.add_argument("-C", "--plan-cache", type=int, default=0,
+                        help="Keep up to N mixing plans in a LRU cache. default: 0 (off)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Dither row bands on N processes. default: 1")
     args = parser.parse_args()
 
     if args.mode < 0 or args.mode > 8:
@@ -986,10 +984,18 @@ def main():
         # print("Palette file is None")
         palette = pal
 
+    cache = None
+    if args.plan_cache > 0:
+        cache = PlanCache(args.plan_cache)
+
     srcim = Image.open(args.input)
-    im = convert_dither(srcim, args.mode, args.dither, args.ciede2000, palette)
+    im = convert_dither(srcim, args.mode, args.dither, args.ciede2000, palette, cache,
+                        args.jobs)
     im.save(args.output)
 
+    if cache is not None:
+        print(cache.stats())
+
 
 if __name__ == '__main__':
     main()